@@ -1,3 +1,5 @@
+import importlib.util
+import multiprocessing
 import os
 import sys
 import subprocess
@@ -6,8 +8,20 @@ from tkinter import filedialog, messagebox, ttk
 from pathlib import Path
 import threading
 import re
+import shutil
+import signal
+import tempfile
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import freecad_pool
+import stl_engine
+
+# 超时的输入文件被移入其所在目录下的这个子目录，批量扫描时跳过
+QUARANTINE_DIR = "_quarantine"
+# 按输出目录判断ODA是否还有进展时，检查该目录的间隔（秒）
+ODA_POLL_INTERVAL = 1.0
 
 class CADConverter:
     """
@@ -25,17 +39,27 @@ class CADConverter:
             # 添加其他可能的路径
         ]
         
-        # 检查FreeCAD可用性
+        # 检查FreeCAD可用性（只查找模块，FreeCAD在常驻工作进程中导入）
         self.freecad_available = False
         try:
-            import FreeCAD
-            import Part
-            import Mesh
-            self.freecad_available = True
-        except ImportError:
-            print("警告: FreeCAD未安装或无法导入，3D文件转换功能将不可用")
-        except Exception as e:
+            self.freecad_available = importlib.util.find_spec("FreeCAD") is not None
+        except (ImportError, ValueError) as e:
             print(f"警告: FreeCAD初始化错误 - {str(e)}")
+        if not self.freecad_available:
+            print("警告: FreeCAD未安装或无法导入，3D文件转换功能将不可用")
+        
+        # 3D转换使用的常驻FreeCAD工作进程数、每个进程的任务数和内存上限，进程池在首次使用时创建
+        self.freecad_workers = os.cpu_count() or 1
+        self.freecad_max_jobs = freecad_pool.DEFAULT_MAX_JOBS
+        self.freecad_max_rss = freecad_pool.DEFAULT_MAX_RSS
+        self._freecad_pool = None
+        self._freecad_pool_lock = threading.Lock()
+        
+        # 批量转换时同时运行的ODA进程数
+        self.oda_workers = os.cpu_count() or 1
+        
+        # 每个文件允许ODA运行的最长时间（秒），None表示不限制
+        self.oda_timeout = 300
         
         # 初始化预览管理器
         self.preview_manager = None
@@ -82,8 +106,15 @@ class CADConverter:
             # 3D格式
             "STEP格式": "STEP",
             "IGES格式": "IGES",
-            "STL格式": "STL"
+            "STL格式": "STL",
+            "STL格式(ASCII)": "STL_ASCII"
         }
+        # ASCII STL由numpy引擎写出，没有numpy时不提供该格式
+        if not stl_engine.available():
+            del self.output_formats["STL格式(ASCII)"]
+        
+        # STL转STL时的坐标缩放比例（如英寸转毫米为25.4）
+        self.stl_scale = 1.0
         
     def find_oda_converter(self):
         """查找ODA File Converter的安装路径"""
@@ -171,6 +202,10 @@ class CADConverter:
             if file_ext in ['.dwg', '.dxf']:
                 return self._convert_2d_file(input_file, output_dir, output_format, audit, safe_progress)
             
+            # STL转STL（格式互转、缩放）直接用numpy处理，不经过FreeCAD
+            elif file_ext == '.stl' and output_format in ['STL', 'STL_ASCII'] and stl_engine.available():
+                return self._convert_stl_file(input_file, output_dir, output_format, safe_progress)
+            
             # 3D格式转换(STEP/STP/IGES/IGS/STL)
             elif file_ext in ['.step', '.stp', '.iges', '.igs', '.stl']:
                 return self._convert_3d_file(input_file, output_dir, output_format, safe_progress)
@@ -195,88 +230,400 @@ class CADConverter:
             if progress_callback:
                 progress_callback(10)
             
-            # 准备输入和输出目录的绝对路径
-            input_dir = os.path.dirname(os.path.abspath(input_file))
-            output_dir = os.path.abspath(output_dir)
-            
-            # 确保输出目录存在
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # 准备命令行参数
-            input_filename = os.path.basename(input_file)
-            audit_flag = "1" if audit else "0"
-            recursive_flag = "0"  # 单文件转换不需要递归
-            
-            # 确定输入格式
-            input_ext = os.path.splitext(input_file)[1].lower()
-            input_format = "DWG" if input_ext == ".dwg" else "DXF"
-            
-            # 构建命令
-            cmd = [
-                oda_path,
-                input_dir,                # 输入目录
-                output_dir,               # 输出目录
-                output_format,            # 输出格式
-                input_format,             # 输入格式
-                audit_flag,               # 审核标志
-                recursive_flag,           # 递归标志
-                input_filename            # 输入文件名
-            ]
-            
-            print(f"执行命令: {' '.join(cmd)}")
+            # 与批量转换走同一流程：ODA输出先写入临时目录，核对成功后再移到输出目录，
+            # 超时或失败时不会删除输出目录中已有的文件
+            input_file = os.path.abspath(input_file)
+            results = {}
             
             if progress_callback:
-                progress_callback(30)
+                progress_callback(50)
+            self._convert_2d_job(oda_path, self._input_format(input_file), os.path.abspath(output_dir),
+                                 [input_file], output_format, audit, results.__setitem__)
+            success = results.get(input_file, False)
             
-            # 执行转换
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if success and progress_callback:
+                progress_callback(100)
+            return success
+        except Exception as e:
+            print(f"错误: 执行转换时出错 - {str(e)}")
+            traceback.print_exc()  # 打印详细的错误堆栈
+            return False
+    
+    def _input_format(self, input_file):
+        """根据扩展名确定ODA输入格式"""
+        input_ext = os.path.splitext(input_file)[1].lower()
+        return "DWG" if input_ext == ".dwg" else "DXF"
+    
+    def _output_extension(self, output_format):
+        """根据ODA输出格式代码确定输出文件扩展名（DXF*为.dxf，ACAD*为.dwg）"""
+        return ".dxf" if output_format.upper().startswith("DXF") else ".dwg"
+    
+    def _expected_2d_output(self, input_filename, output_dir, output_format):
+        """返回2D输入文件在输出目录中对应的输出文件路径"""
+        output_basename = os.path.splitext(os.path.basename(input_filename))[0]
+        return os.path.join(output_dir, output_basename + self._output_extension(output_format))
+    
+    def _build_oda_command(self, oda_path, input_dir, output_dir, output_format, input_format,
+                           audit, file_filter):
+        """
+        构建ODA File Converter命令行
+        
+        参数:
+            file_filter (str): 文件名或通配符，如"drawing.dwg"或"*.DWG"
+        """
+        return [
+            oda_path,
+            input_dir,                    # 输入目录
+            output_dir,                   # 输出目录
+            output_format,                # 输出格式
+            input_format,                 # 输入格式
+            "1" if audit else "0",        # 审核标志
+            "0",                          # 递归标志（目录由调用方分组，不需要递归）
+            file_filter                   # 文件名或通配符
+        ]
+    
+    def _run_oda(self, cmd, timeout=None, watch_dir=None):
+        """
+        执行一次ODA File Converter并等待结束
+        
+        同时读取stdout和stderr，避免输出过多时管道写满造成死锁；超时后终止整个进程树。
+        
+        参数:
+            cmd (list): 命令行
+            timeout (float): 最长运行时间（秒），None表示不限制
+            watch_dir (str): 给出时 timeout 表示无进展的时限：该目录中每出现一个新文件
+                （ODA写完一个输出）就重新计时，分组再大也能按单个文件的时限发现卡住的图纸
+        
+        返回:
+            tuple: (返回码, 错误输出文本, 是否超时)
+        """
+        if os.name == 'nt':
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            # 独立会话，超时时可以按进程组一起终止ODA及其子进程
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       start_new_session=True)
+        
+        deadline = None if timeout is None else time.monotonic() + timeout
+        outputs = 0
+        while True:
+            wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if watch_dir is not None and wait is not None:
+                wait = min(wait, ODA_POLL_INTERVAL)
+            try:
+                # 超时后再次调用 communicate 不会丢失已读到的输出
+                _, stderr = process.communicate(timeout=wait)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if watch_dir is not None:
+                try:
+                    count = len(os.listdir(watch_dir))
+                except OSError:
+                    count = outputs
+                if count != outputs:
+                    outputs = count
+                    deadline = time.monotonic() + timeout
+                    continue
+            if time.monotonic() < deadline:
+                continue
+            if watch_dir is None:
+                print(f"错误: ODA运行超过 {timeout:g} 秒，终止进程: {' '.join(cmd)}")
+            else:
+                print(f"错误: ODA {timeout:g} 秒内没有产生新的输出，终止进程: {' '.join(cmd)}")
+            self._kill_process_tree(process)
+            try:
+                _, stderr = process.communicate(timeout=10)
+            except subprocess.TimeoutExpired:
+                stderr = b""
+            return process.returncode, stderr.decode('utf-8', errors='ignore'), True
+        
+        return process.returncode, stderr.decode('utf-8', errors='ignore'), False
+    
+    def _kill_process_tree(self, process):
+        """终止进程及其全部子进程"""
+        try:
+            if os.name == 'nt':
+                subprocess.run(["taskkill", "/T", "/F", "/PID", str(process.pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"警告: 终止进程树失败 - {str(e)}")
+        try:
+            process.kill()
+        except OSError:
+            pass
+    
+    def _quarantine_input(self, input_file):
+        """
+        把超时的输入文件移入同目录下的隔离子目录，下次批量转换时不再处理
+        
+        返回:
+            str: 隔离后的路径，失败时为None
+        """
+        quarantine_dir = os.path.join(os.path.dirname(os.path.abspath(input_file)), QUARANTINE_DIR)
+        target = os.path.join(quarantine_dir, os.path.basename(input_file))
+        try:
+            os.makedirs(quarantine_dir, exist_ok=True)
+            if os.path.exists(target):
+                name, ext = os.path.splitext(os.path.basename(input_file))
+                target = os.path.join(quarantine_dir, f"{name}_{int(time.time())}{ext}")
+            shutil.move(input_file, target)
+        except OSError as e:
+            print(f"警告: 无法隔离超时文件 {input_file} - {str(e)}")
+            return None
+        print(f"警告: 文件转换超时，已移入隔离目录: {target}")
+        return target
+    
+    def _stage_2d_group(self, input_files, output_dir):
+        """
+        把一组2D文件硬链接（失败时复制）到独立的临时目录，作为ODA的输入目录
+        
+        ODA按整个目录工作，每个任务使用自己的暂存目录，避免转换不属于本任务的文件。
+        暂存目录建在输出目录下，输入与输出同盘时可以硬链接而不必复制。
+        
+        返回:
+            str: 暂存目录路径
+        """
+        staging_dir = tempfile.mkdtemp(prefix=".oda_stage_", dir=output_dir)
+        try:
+            for path in input_files:
+                staged = os.path.join(staging_dir, os.path.basename(path))
+                try:
+                    os.link(path, staged)
+                except OSError:
+                    shutil.copy2(path, staged)
+        except BaseException:
+            # 暂存失败时调用方拿不到目录路径，在这里删除
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        return staging_dir
+    
+    def _convert_2d_job(self, oda_path, input_format, output_dir, input_files, output_format, audit, report):
+        """
+        用一次ODA调用转换一组2D文件，并逐个核对输出
+        
+        输入暂存到独立目录，ODA输出写入目标目录下的独立临时目录，
+        核对成功的文件再移动到目标目录，并发任务之间互不干扰。
+        整组超时后未完成的文件逐个重试，单个文件仍超时则隔离。
+        """
+        file_filter = "*." + input_format
+        staging_dir = None
+        job_output_dir = None
+        retry = []
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            staging_dir = self._stage_2d_group(input_files, output_dir)
+            job_output_dir = tempfile.mkdtemp(prefix=".oda_out_", dir=output_dir)
+            cmd = self._build_oda_command(oda_path, staging_dir, job_output_dir, output_format,
+                                          input_format, audit, file_filter)
+            print(f"执行命令: {' '.join(cmd)} ({len(input_files)} 个文件)")
             
-            # 读取输出流
-            while True:
-                if process.poll() is not None:
-                    break
-                if progress_callback:
-                    progress_callback(50)
-                time.sleep(0.1)
+            # 按单个文件的时限计时：每产生一个输出重新计时，不随分组大小放宽
+            returncode, error_msg, timed_out = self._run_oda(cmd, self.oda_timeout or None, job_output_dir)
+            if timed_out and len(input_files) == 1:
+                self._quarantine_input(input_files[0])
+                report(input_files[0], False)
+                return
+            if returncode != 0 and not timed_out:
+                print(f"错误: ODA转换失败 (返回码: {returncode}) - {error_msg}")
             
-            if progress_callback:
-                progress_callback(90)
+            # ODA对整组只给出一个返回码，逐个文件以非空输出为准
+            produced = {}
+            for input_file in input_files:
+                job_output = self._expected_2d_output(input_file, job_output_dir, output_format)
+                if os.path.exists(job_output) and os.path.getsize(job_output) > 0:
+                    produced[input_file] = job_output
             
-            # 检查是否成功
-            if process.returncode == 0:
-                # 验证输出文件是否存在
-                output_basename = os.path.splitext(input_filename)[0]
-                output_ext = ".dwg" if "DWG" in output_format else ".dxf"
-                expected_output = os.path.join(output_dir, output_basename + output_ext)
-                
-                if not os.path.exists(expected_output):
+            if timed_out:
+                # 被终止时正在写入的输出可能不完整，连同未完成的文件逐个重新转换，
+                # 找出真正卡住的文件并隔离
+                if produced:
+                    del produced[max(produced, key=lambda f: os.path.getmtime(produced[f]))]
+                retry = [input_file for input_file in input_files if input_file not in produced]
+                print(f"警告: 分组转换超时，{len(retry)} 个文件将逐个重试")
+            
+            for input_file in input_files:
+                expected_output = self._expected_2d_output(input_file, output_dir, output_format)
+                job_output = self._expected_2d_output(input_file, job_output_dir, output_format)
+                if input_file in produced:
+                    os.replace(produced[input_file], expected_output)
+                    print(f"成功: 文件已转换并保存到: {expected_output}")
+                    report(input_file, True)
+                elif input_file in retry:
+                    continue
+                elif not os.path.exists(job_output):
                     print(f"错误: 转换失败 - 未找到输出文件: {expected_output}")
-                    return False
-                
-                if os.path.getsize(expected_output) == 0:
+                    report(input_file, False)
+                else:
                     print(f"错误: 转换失败 - 输出文件为空: {expected_output}")
-                    os.remove(expected_output)  # 删除空文件
-                    return False
-                
-                if progress_callback:
-                    progress_callback(100)
-                
-                print(f"成功: 文件已转换并保存到: {expected_output}")
-                return True
-            else:
-                error_msg = process.stderr.read().decode('utf-8', errors='ignore')
-                print(f"错误: ODA转换失败 (返回码: {process.returncode}) - {error_msg}")
-                return False
+                    report(input_file, False)
         except Exception as e:
             print(f"错误: 执行转换时出错 - {str(e)}")
-            traceback.print_exc()  # 打印详细的错误堆栈
+            traceback.print_exc()
+            for input_file in input_files:
+                report(input_file, False)
+        finally:
+            # 删除暂存目录和ODA留下的其余文件（如空输出）
+            for path in (staging_dir, job_output_dir):
+                if path:
+                    shutil.rmtree(path, ignore_errors=True)
+        
+        for input_file in retry:
+            self._convert_2d_job(oda_path, input_format, output_dir, [input_file], output_format, audit, report)
+    
+    def convert_2d_batch(self, jobs, output_format, audit=True, result_callback=None, workers=None):
+        """
+        按源目录分组批量转换2D文件(DWG/DXF)，最多同时运行workers个ODA进程
+        
+        同一源目录、同一输入格式、同一输出目录的文件为一组，使用通配符调用ODA，
+        之后根据输出文件逐个核对每个文件是否转换成功。文件较多时，大的分组会拆成
+        多个任务，使所有ODA进程都有活干。
+        
+        参数:
+            jobs (list): [(输入文件路径, 输出目录), ...]
+            output_format (str): 输出格式代码
+            audit (bool): 是否在转换过程中审核文件
+            result_callback (function): 每个文件核对完成后调用 (输入文件, 是否成功)，可能来自工作线程
+            workers (int): 并发ODA进程数，None表示使用self.oda_workers
+        
+        返回:
+            dict: {输入文件路径: 是否成功}
+        """
+        results = {}
+        lock = threading.Lock()
+        
+        def report(input_file, success):
+            with lock:
+                results[input_file] = success
+                if result_callback:
+                    try:
+                        result_callback(input_file, success)
+                    except Exception as e:
+                        print(f"警告: 结果回调失败 - {str(e)}")
+        
+        groups = {}
+        for input_file, output_dir in jobs:
+            input_file = os.path.abspath(input_file)
+            key = (os.path.dirname(input_file), self._input_format(input_file), os.path.abspath(output_dir))
+            groups.setdefault(key, []).append(input_file)
+        if not groups:
+            return results
+        
+        oda_path = self.find_oda_converter()
+        if not oda_path:
+            print("错误: 未找到ODA File Converter，请确保已正确安装")
+            for input_files in groups.values():
+                for input_file in input_files:
+                    report(input_file, False)
+            return results
+        
+        # 每个任务最多分到总数/进程数个文件，兼顾进程启动次数和并行度
+        workers = max(1, workers or self.oda_workers)
+        total_files = sum(len(input_files) for input_files in groups.values())
+        per_job = max(1, -(-total_files // workers))
+        tasks = []
+        for (_, input_format, output_dir), input_files in groups.items():
+            for start in range(0, len(input_files), per_job):
+                tasks.append((input_format, output_dir, input_files[start:start + per_job]))
+        
+        if workers == 1 or len(tasks) == 1:
+            for input_format, output_dir, input_files in tasks:
+                self._convert_2d_job(oda_path, input_format, output_dir, input_files, output_format, audit, report)
+        else:
+            with ThreadPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+                futures = [
+                    executor.submit(self._convert_2d_job, oda_path, input_format, output_dir,
+                                    input_files, output_format, audit, report)
+                    for input_format, output_dir, input_files in tasks
+                ]
+                for future in futures:
+                    future.result()
+        
+        return results
+    
+    def _convert_stl_file(self, input_file, output_dir, output_format, progress_callback=None):
+        """使用numpy STL引擎转换STL文件(二进制/ASCII互转、缩放)"""
+        output_basename = os.path.splitext(os.path.basename(input_file))[0]
+        output_file = os.path.join(output_dir, output_basename + ".stl")
+        # 先写临时文件，输出与输入相同时也不会在读完前被覆盖
+        temp_file = output_file + ".part"
+        try:
+            if progress_callback:
+                progress_callback(10)
+            count = stl_engine.convert([input_file], temp_file, output_format == "STL", self.stl_scale)
+            if progress_callback:
+                progress_callback(90)
+            if count == 0:
+                print(f"错误: STL转换失败 - 文件中没有三角形: {input_file}")
+                os.remove(temp_file)
+                return False
+            os.replace(temp_file, output_file)
+        except Exception as e:
+            print(f"错误: STL转换过程中发生异常 - {str(e)}")
+            traceback.print_exc()
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
             return False
+        
+        if progress_callback:
+            progress_callback(100)
+        print(f"成功: STL文件已转换并保存到: {output_file} ({count} 个三角形)")
+        return True
+    
+    def merge_stl_files(self, input_files, output_file, binary=True, scale=None):
+        """
+        把多个STL文件合并为一个
+        
+        参数:
+            input_files (list): 输入STL文件路径
+            output_file (str): 输出文件路径
+            binary (bool): 输出二进制(True)或ASCII(False)
+            scale (float): 坐标缩放比例，None表示使用self.stl_scale
+        
+        返回:
+            bool: 合并是否成功
+        """
+        if not stl_engine.available():
+            print("错误: 合并STL需要numpy")
+            return False
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+            count = stl_engine.convert(input_files, output_file, binary,
+                                       self.stl_scale if scale is None else scale)
+        except Exception as e:
+            print(f"错误: 合并STL时出错 - {str(e)}")
+            traceback.print_exc()
+            return False
+        print(f"成功: {len(input_files)} 个STL文件已合并到: {output_file} ({count} 个三角形)")
+        return True
+    
+    def get_freecad_pool(self):
+        """返回常驻FreeCAD工作进程池，首次调用时创建"""
+        with self._freecad_pool_lock:
+            if self._freecad_pool is None:
+                self._freecad_pool = freecad_pool.FreeCADPool(
+                    self.freecad_workers, self.freecad_max_jobs, self.freecad_max_rss
+                )
+            return self._freecad_pool
+    
+    def close(self):
+        """停止常驻的FreeCAD工作进程"""
+        with self._freecad_pool_lock:
+            if self._freecad_pool is not None:
+                self._freecad_pool.close()
+                self._freecad_pool = None
     
     def _convert_3d_file(self, input_file, output_dir, output_format, progress_callback=None):
-        """使用FreeCAD转换3D文件"""
+        """使用常驻FreeCAD工作进程转换3D文件"""
         if not self.freecad_available:
             print("错误: FreeCAD未安装或不可用，无法转换3D文件")
             return False
+        if output_format == "STL_ASCII" and not stl_engine.available():
+            print("错误: 输出ASCII STL需要numpy")
+            return False
             
         try:
             # 安全地调用进度回调
@@ -298,11 +645,7 @@ class CADConverter:
             output_basename = os.path.splitext(input_basename)[0]
             
             # 根据输出格式确定文件扩展名
-            output_ext = {
-                "STEP": ".step",
-                "IGES": ".iges",
-                "STL": ".stl"
-            }.get(output_format)
+            output_ext = freecad_pool.OUTPUT_EXTENSIONS.get(output_format)
             
             if not output_ext:
                 print(f"错误: 不支持的3D输出格式: {output_format}")
@@ -320,43 +663,23 @@ class CADConverter:
             # 确保输出目录存在
             os.makedirs(output_dir, exist_ok=True)
             
-            # 加载输入文件
-            shape = None
-            input_ext = os.path.splitext(input_file)[1].lower()
-            
-            try:
-                if input_ext in ['.step', '.stp']:
-                    shape = Part.read(input_file)
-                elif input_ext in ['.iges', '.igs']:
-                    shape = Part.read(input_file)
-                elif input_ext == '.stl':
-                    mesh = Mesh.Mesh(input_file)
-                    shape = Part.Shape()
-                    shape.makeShapeFromMesh(mesh.Topology, 0.1)
-                else:
-                    print(f"错误: 不支持的输入格式: {input_ext}")
-                    return False
-            except Exception as e:
-                print(f"错误: 无法加载3D文件 - {str(e)}")
-                return False
-            
-            update_progress(60)
-            
-            if not shape:
-                print("错误: 无法创建3D形状")
-                return False
-            
-            # 导出到目标格式
-            try:
-                if output_format == "STEP":
-                    shape.exportStep(output_file)
-                elif output_format == "IGES":
-                    shape.exportIges(output_file)
-                elif output_format == "STL":
-                    shape.exportStl(output_file)
-            except Exception as e:
-                print(f"错误: 导出文件失败 - {str(e)}")
+            # 在常驻FreeCAD工作进程中加载并导出
+            update_progress(40)
+            export_format = "STL" if output_format == "STL_ASCII" else output_format
+            error = self.get_freecad_pool().convert(input_file, output_file, export_format)
+            if error:
+                print(f"错误: {error}")
                 return False
+            if output_format == "STL_ASCII":
+                try:
+                    stl_engine.convert([output_file], output_file + ".part", binary=False)
+                    os.replace(output_file + ".part", output_file)
+                except Exception:
+                    # 不留下二进制的输出冒充ASCII结果
+                    for path in (output_file + ".part", output_file):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    raise
             
             update_progress(90)
             
@@ -424,7 +747,7 @@ class CADConverter:
             
         return result
 
-    def convert_directory(self, input_dir, output_dir, output_format, audit=True):
+    def convert_directory(self, input_dir, output_dir, output_format, audit=True, workers=None):
         """
         转换目录中的所有CAD文件
         
@@ -433,24 +756,33 @@ class CADConverter:
             output_dir (str): 输出目录路径
             output_format (str): 输出格式代码，如"ACAD2007"
             audit (bool): 是否在转换过程中审核文件
+            workers (int): 并发ODA进程数，None表示使用self.oda_workers
         
         返回:
             tuple: (成功转换的文件数, 失败的文件数)
         """
-        success_count = 0
-        failure_count = 0
-        
         # 确保输出目录存在
         os.makedirs(output_dir, exist_ok=True)
         
-        # 遍历输入目录中的所有文件
-        for root, _, files in os.walk(input_dir):
+        jobs = self.collect_jobs(input_dir, output_dir)
+        success_count, failure_count = self.convert_jobs(jobs, output_format, audit, workers=workers)
+        
+        return success_count, failure_count
+
+    def collect_jobs(self, input_dir, output_dir):
+        """
+        收集目录中所有待转换的CAD文件，并创建保持目录结构的输出子目录
+        
+        返回:
+            list: [(输入文件路径, 输出目录), ...]
+        """
+        jobs = []
+        for root, dirs, files in os.walk(input_dir):
+            # 跳过隔离目录和ODA任务的临时目录
+            dirs[:] = [d for d in dirs if d != QUARANTINE_DIR and not d.startswith(".oda_")]
             for file in files:
                 # 检查文件扩展名
                 if any(file.lower().endswith(ext) for ext in self.input_formats):
-                    # 构建输入文件的完整路径
-                    input_file = os.path.join(root, file)
-                    
                     # 计算相对路径，以保持目录结构
                     rel_path = os.path.relpath(root, input_dir)
                     if rel_path == ".":
@@ -458,14 +790,48 @@ class CADConverter:
                     else:
                         target_dir = os.path.join(output_dir, rel_path)
                         os.makedirs(target_dir, exist_ok=True)
-                    
-                    # 转换文件
-                    if self.convert_file(input_file, target_dir, output_format, audit, False):
-                        success_count += 1
-                    else:
-                        failure_count += 1
+                    jobs.append((os.path.join(root, file), target_dir))
+        return jobs
+    
+    def convert_jobs(self, jobs, output_format, audit=True, result_callback=None, workers=None):
+        """
+        转换一批文件：2D文件按目录分组交给ODA批量转换，3D文件交给常驻FreeCAD工作进程并行转换
         
-        return success_count, failure_count
+        参数:
+            jobs (list): [(输入文件路径, 输出目录), ...]
+            output_format (str): 输出格式代码
+            audit (bool): 是否在转换过程中审核文件
+            result_callback (function): 每个文件完成后调用 (输入文件, 是否成功)
+            workers (int): 并发ODA进程数，None表示使用self.oda_workers
+        
+        返回:
+            tuple: (成功转换的文件数, 失败的文件数)
+        """
+        jobs_2d = [job for job in jobs if os.path.splitext(job[0])[1].lower() in ['.dwg', '.dxf']]
+        other_jobs = [job for job in jobs if os.path.splitext(job[0])[1].lower() not in ['.dwg', '.dxf']]
+        
+        results = self.convert_2d_batch(jobs_2d, output_format, audit, result_callback, workers)
+        success_count = sum(1 for success in results.values() if success)
+        failure_count = len(results) - success_count
+        
+        # 3D文件由多个常驻FreeCAD工作进程并行转换
+        lock = threading.Lock()
+        counts = {'success': success_count, 'failure': failure_count}
+        
+        def convert_one(job):
+            input_file, target_dir = job
+            success = self.convert_file(input_file, target_dir, output_format, audit, False)
+            with lock:
+                counts['success' if success else 'failure'] += 1
+                if result_callback:
+                    result_callback(input_file, success)
+        
+        if other_jobs:
+            with ThreadPoolExecutor(max_workers=min(self.freecad_workers, len(other_jobs))) as executor:
+                for future in [executor.submit(convert_one, job) for job in other_jobs]:
+                    future.result()
+        
+        return counts['success'], counts['failure']
 
 
 class CADConverterGUI:
@@ -640,6 +1006,13 @@ class CADConverterGUI:
         audit_check = ttk.Checkbutton(options_frame, text="审核并修复文件", variable=self.batch_audit_var)
         audit_check.pack(anchor=tk.W, padx=5, pady=5)
         
+        workers_frame = ttk.Frame(options_frame)
+        workers_frame.pack(anchor=tk.W, padx=5, pady=5)
+        ttk.Label(workers_frame, text="并行ODA进程数:").pack(side=tk.LEFT)
+        self.batch_workers_var = tk.IntVar(value=self.converter.oda_workers)
+        workers_spin = ttk.Spinbox(workers_frame, from_=1, to=64, width=5, textvariable=self.batch_workers_var)
+        workers_spin.pack(side=tk.LEFT, padx=5)
+        
         # 转换按钮
         convert_button = ttk.Button(parent, text="批量转换", command=self.convert_batch)
         convert_button.pack(pady=20)
@@ -747,6 +1120,11 @@ class CADConverterGUI:
         output_dir = self.batch_output_dir_var.get()
         output_format_name = self.batch_format_var.get()
         audit = self.batch_audit_var.get()
+        try:
+            workers = max(1, int(self.batch_workers_var.get()))
+        except (tk.TclError, ValueError):
+            messagebox.showerror("错误", "并行ODA进程数必须是正整数")
+            return
         
         # 验证输入
         if not input_dir:
@@ -777,12 +1155,9 @@ class CADConverterGUI:
         
         # 在后台线程中执行转换
         def do_batch_conversion():
-            # 计算总文件数
-            total_files = 0
-            for root, _, files in os.walk(input_dir):
-                for file in files:
-                    if any(file.lower().endswith(ext) for ext in self.converter.input_formats):
-                        total_files += 1
+            # 收集待转换文件
+            jobs = self.converter.collect_jobs(input_dir, output_dir)
+            total_files = len(jobs)
             
             if total_files == 0:
                 self.root.after(0, lambda: messagebox.showinfo("信息", f"在目录中未找到CAD文件: {input_dir}"))
@@ -792,35 +1167,20 @@ class CADConverterGUI:
             # 更新状态
             self.root.after(0, lambda: self.batch_status_var.set(f"正在转换 0/{total_files} 文件..."))
             
-            # 转换文件
-            success_count = 0
-            failure_count = 0
-            
-            for root, _, files in os.walk(input_dir):
-                for file in files:
-                    if any(file.lower().endswith(ext) for ext in self.converter.input_formats):
-                        # 构建输入文件的完整路径
-                        input_file = os.path.join(root, file)
-                        
-                        # 计算相对路径，以保持目录结构
-                        rel_path = os.path.relpath(root, input_dir)
-                        if rel_path == ".":
-                            target_dir = output_dir
-                        else:
-                            target_dir = os.path.join(output_dir, rel_path)
-                            os.makedirs(target_dir, exist_ok=True)
-                        
-                        # 转换文件
-                        if self.converter.convert_file(input_file, target_dir, output_format, audit, False):
-                            success_count += 1
-                        else:
-                            failure_count += 1
-                        
-                        # 更新进度
-                        progress = (success_count + failure_count) / total_files * 100
-                        self.root.after(0, lambda p=progress, s=success_count, t=total_files: 
-                                        (self.progress_var.set(p), 
-                                         self.batch_status_var.set(f"正在转换 {s}/{t} 文件...")))
+            # 转换文件（2D文件按目录分组，由多个ODA进程并行转换）
+            counts = {'success': 0, 'failure': 0}
+            
+            def on_result(input_file, success):
+                counts['success' if success else 'failure'] += 1
+                
+                # 更新进度
+                progress = (counts['success'] + counts['failure']) / total_files * 100
+                self.root.after(0, lambda p=progress, s=counts['success'], t=total_files: 
+                                (self.progress_var.set(p), 
+                                 self.batch_status_var.set(f"正在转换 {s}/{t} 文件...")))
+            
+            success_count, failure_count = self.converter.convert_jobs(jobs, output_format, audit, on_result,
+                                                                       workers=workers)
             
             # 完成后更新UI
             self.root.after(0, lambda s=success_count, f=failure_count: 
@@ -852,9 +1212,14 @@ class CADConverterGUI:
 
 
 def main():
+    # 打包成exe后，FreeCAD工作进程需要由此进入
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = CADConverterGUI(root)
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        app.converter.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,267 @@
+"""
+常驻FreeCAD工作进程池
+
+每个工作进程只导入一次FreeCAD，通过管道接收3D转换任务。处理满一定数量的任务
+或常驻内存超过上限后，工作进程会被替换，以回收FreeCAD/OCC累积的内存。
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+
+# 单个工作进程最多处理的任务数，之后替换为新进程
+DEFAULT_MAX_JOBS = 50
+# 单个工作进程的常驻内存上限（字节），超过后替换为新进程
+DEFAULT_MAX_RSS = 1024 * 1024 * 1024
+
+# 3D输出格式对应的扩展名
+OUTPUT_EXTENSIONS = {
+    "STEP": ".step",
+    "IGES": ".iges",
+    "STL": ".stl",
+    "STL_ASCII": ".stl"
+}
+
+
+def current_rss():
+    """
+    返回当前进程的常驻内存（字节）
+
+    返回:
+        int: 常驻内存字节数，无法获取时为None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    if os.name == 'nt':
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [
+                    ("cb", wintypes.DWORD),
+                    ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t),
+                    ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t),
+                    ("PeakPagefileUsage", ctypes.c_size_t),
+                ]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return counters.WorkingSetSize
+        except Exception:
+            pass
+    return None
+
+
+def convert_shape(input_file, output_file, output_format):
+    """
+    在当前进程中用FreeCAD读取3D文件并导出为目标格式
+
+    参数:
+        input_file (str): 输入文件路径(STEP/IGES/STL)
+        output_file (str): 输出文件路径
+        output_format (str): "STEP"、"IGES"或"STL"
+
+    返回:
+        str: 错误信息，成功时为None
+    """
+    import Part
+    import Mesh
+
+    input_ext = os.path.splitext(input_file)[1].lower()
+    try:
+        if input_ext in ['.step', '.stp', '.iges', '.igs']:
+            shape = Part.read(input_file)
+        elif input_ext == '.stl':
+            mesh = Mesh.Mesh(input_file)
+            shape = Part.Shape()
+            shape.makeShapeFromMesh(mesh.Topology, 0.1)
+        else:
+            return f"不支持的输入格式: {input_ext}"
+    except Exception as e:
+        return f"无法加载3D文件 - {str(e)}"
+
+    if not shape:
+        return "无法创建3D形状"
+
+    try:
+        if output_format == "STEP":
+            shape.exportStep(output_file)
+        elif output_format == "IGES":
+            shape.exportIges(output_file)
+        elif output_format == "STL":
+            shape.exportStl(output_file)
+        else:
+            return f"不支持的3D输出格式: {output_format}"
+    except Exception as e:
+        return f"导出文件失败 - {str(e)}"
+    return None
+
+
+def _worker_main(conn):
+    """
+    工作进程入口：导入FreeCAD后循环接收任务，收到None时退出
+
+    每个任务回复 (错误信息或None, 当前常驻内存)。
+    """
+    try:
+        import FreeCAD  # noqa: F401
+        import Part  # noqa: F401
+        import Mesh  # noqa: F401
+    except Exception as e:
+        conn.send(f"FreeCAD初始化失败 - {str(e)}")
+        conn.close()
+        return
+    conn.send(None)
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        try:
+            error = convert_shape(*job)
+        except Exception as e:
+            traceback.print_exc()
+            error = f"3D转换过程中发生异常 - {str(e)}"
+        conn.send((error, current_rss()))
+    conn.close()
+
+
+class FreeCADWorker:
+    """一个常驻的FreeCAD工作进程及其管道"""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.rss = None
+
+        try:
+            error = self.conn.recv()
+        except EOFError:
+            error = "FreeCAD工作进程启动后意外退出"
+        if error:
+            self.stop()
+            raise RuntimeError(error)
+
+    def run(self, input_file, output_file, output_format):
+        """
+        在工作进程中执行一个转换任务
+
+        返回:
+            str: 错误信息，成功时为None
+        """
+        self.conn.send((input_file, output_file, output_format))
+        self.jobs += 1
+        error, self.rss = self.conn.recv()
+        return error
+
+    def stop(self):
+        """通知工作进程退出并回收"""
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class FreeCADPool:
+    """
+    常驻FreeCAD工作进程池
+
+    参数:
+        workers (int): 最多同时运行的工作进程数
+        max_jobs (int): 单个工作进程处理多少个任务后被替换
+        max_rss (int): 单个工作进程常驻内存超过多少字节后被替换，None表示不检查
+    """
+
+    def __init__(self, workers=None, max_jobs=DEFAULT_MAX_JOBS, max_rss=DEFAULT_MAX_RSS):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        # 使用spawn，避免在带Tk线程的进程中fork
+        self.context = multiprocessing.get_context("spawn")
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.closed = False
+
+    def _acquire(self):
+        """取一个空闲工作进程，没有则新建（数量受workers限制）"""
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return FreeCADWorker(self.context)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _release(self, worker):
+        """归还工作进程；达到任务数或内存上限时替换"""
+        recycle = (
+            self.closed
+            or (self.max_jobs and worker.jobs >= self.max_jobs)
+            or (self.max_rss and worker.rss and worker.rss > self.max_rss)
+        )
+        if recycle:
+            worker.stop()
+        else:
+            self.idle.put(worker)
+        self.slots.release()
+
+    def convert(self, input_file, output_file, output_format):
+        """
+        在某个工作进程中转换一个3D文件，可以从多个线程同时调用
+
+        返回:
+            str: 错误信息，成功时为None
+        """
+        try:
+            worker = self._acquire()
+        except Exception as e:
+            return str(e)
+
+        try:
+            error = worker.run(input_file, output_file, output_format)
+        except (EOFError, OSError) as e:
+            # 工作进程崩溃（如OCC内部错误），丢弃它，下次任务会新建
+            self.slots.release()
+            worker.stop()
+            return f"FreeCAD工作进程异常退出 - {str(e) or type(e).__name__}"
+
+        self._release(worker)
+        return error
+
+    def close(self):
+        """停止所有空闲工作进程"""
+        self.closed = True
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.stop()
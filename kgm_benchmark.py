@@ -0,0 +1,321 @@
+"""
+KGM转换性能基准测试
+
+生成合成的KGM语料（大量小文件、少量大文件、混合大小），按不同配置
+（分块大小、进程数、是否内存映射、是否流水线）测量 MB/s、文件/s 和峰值内存
+（主进程与所有工作进程常驻内存之和的峰值，以及单个进程的峰值），
+每个配置重复运行多次（--repeat）取吞吐量中位数，结果写入JSON，
+并可与保存的基线比较以发现性能回退。
+
+用法:
+    python kgm_benchmark.py -o bench.json
+    python kgm_benchmark.py -o bench.json --baseline baseline.json
+    python kgm_benchmark.py --scale 0.1 --quick --repeat 5
+
+每个配置在独立的子进程中运行，峰值内存互不影响。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import kgm_core
+
+try:
+    import resource
+except ImportError:  # Windows没有resource模块，峰值内存记为None
+    resource = None
+
+MB = 1024 * 1024
+
+# 语料定义：名称 -> [(文件数, 单个文件字节数), ...]，字节数会乘以 --scale
+CORPORA = {
+    "tiny": [(2000, 16 * 1024)],
+    "huge": [(2, 512 * MB)],
+    "mixed": [(500, 64 * 1024), (50, 4 * MB), (4, 64 * MB)],
+}
+
+# 测试配置：名称 -> ConversionPool 参数
+CONFIGS = {
+    "stream-1w-4m": {"workers": 1, "chunk_size": 4 * MB, "use_mmap": False},
+    "stream-1w-256k": {"workers": 1, "chunk_size": 256 * 1024, "use_mmap": False},
+    "stream-Nw-4m": {"workers": None, "chunk_size": 4 * MB, "use_mmap": False},
+    "mmap-1w-4m": {"workers": 1, "chunk_size": 4 * MB, "use_mmap": True},
+    "mmap-Nw-4m": {"workers": None, "chunk_size": 4 * MB, "use_mmap": True},
+    "pipeline-4m": {"pipeline": True, "chunk_size": 4 * MB, "use_mmap": False},
+}
+
+QUICK_CONFIGS = ("stream-1w-4m", "stream-Nw-4m", "mmap-1w-4m", "pipeline-4m")
+
+
+def generate_corpus(directory, spec, scale=1.0, seed=0):
+    """生成合成语料，内容为可复现的伪随机数据"""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    block = bytes(rng.getrandbits(8) for _ in range(MB))
+    index = 0
+    for count, size in spec:
+        size = max(1, int(size * scale))
+        for _ in range(count):
+            path = os.path.join(directory, f"track_{index:06d}.kgm")
+            with open(path, 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    f.write(block[:min(remaining, len(block))])
+                    remaining -= len(block)
+            index += 1
+
+
+def process_rss_kb(pid):
+    """读取进程当前的常驻内存（KB），没有 /proc 时返回None"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class RssSampler:
+    """
+    后台线程定期采样本进程和所有工作进程的常驻内存之和，记录峰值（KB）
+
+    ru_maxrss 只给出单个进程的峰值，多进程配置下反映不了总内存占用。
+    进入和退出时各采样一次，运行时间短于采样间隔时也有结果。
+    没有 /proc 的平台上 peak 为None。
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        total = process_rss_kb(os.getpid())
+        if total is None:
+            return
+        for child in multiprocessing.active_children():
+            total += process_rss_kb(child.pid) or 0
+        self.peak = max(self.peak or 0, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return False
+
+
+def max_process_rss_kb():
+    """返回本进程及已结束子进程中单个进程的峰值常驻内存（KB）"""
+    if resource is None:
+        return None
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    rss = max(self_rss, child_rss)
+    # macOS以字节为单位，Linux以KB为单位
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run_one(corpus_dir, output_dir, config):
+    """在当前进程中运行一个配置，返回测量结果"""
+    files = sorted(
+        os.path.join(corpus_dir, name) for name in os.listdir(corpus_dir) if name.endswith('.kgm')
+    )
+    os.makedirs(output_dir, exist_ok=True)
+
+    pool = kgm_core.ConversionPool(**config)
+    converted = 0
+    total_bytes = 0
+    failures = 0
+    start = time.perf_counter()
+    with RssSampler() as sampler:
+        for result in pool.run((path, output_dir) for path in files):
+            if result['error']:
+                failures += 1
+            else:
+                converted += 1
+                total_bytes += result['size']
+            if converted + failures == len(files):
+                # 进程池关闭前最后采样一次，工作进程退出后就采不到了
+                sampler.sample()
+    seconds = time.perf_counter() - start
+    max_rss = max_process_rss_kb()
+    # 采样可能错过短暂的峰值，总和至少不小于单个进程的峰值
+    peak_rss = max(filter(None, (sampler.peak, max_rss)), default=None)
+
+    return {
+        "files": converted,
+        "failures": failures,
+        "bytes": total_bytes,
+        "seconds": round(seconds, 4),
+        "mb_s": round(total_bytes / MB / seconds, 2) if seconds > 0 else 0,
+        "files_s": round(converted / seconds, 2) if seconds > 0 else 0,
+        "peak_rss_kb": peak_rss,
+        "max_process_rss_kb": max_rss,
+        "workers": pool.workers,
+    }
+
+
+def run_isolated(corpus_dir, output_dir, config):
+    """在新的Python进程中运行一个配置，使峰值内存只反映该配置"""
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--run-one",
+        json.dumps({"corpus_dir": corpus_dir, "output_dir": output_dir, "config": config})
+    ]
+    completed = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_repeated(corpus_dir, output_dir, config, repeat):
+    """
+    重复运行一个配置，返回吞吐量取中位数的结果
+
+    单次运行容易受页缓存、后台任务等干扰，用中位数与基线比较才不会误报回退。
+    runs 记录每次的 MB/s，峰值内存取各次中的最大值。
+    """
+    runs = []
+    for _ in range(max(1, repeat)):
+        shutil.rmtree(output_dir, ignore_errors=True)
+        runs.append(run_isolated(corpus_dir, output_dir, config))
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    result = dict(runs[0])
+    for key in ("seconds", "mb_s", "files_s"):
+        result[key] = round(statistics.median(run[key] for run in runs), 4)
+    for key in ("peak_rss_kb", "max_process_rss_kb"):
+        values = [run[key] for run in runs if run[key] is not None]
+        result[key] = max(values) if values else None
+    result["failures"] = max(run["failures"] for run in runs)
+    result["runs"] = [run["mb_s"] for run in runs]
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    与基线比较吞吐量（多次运行的中位数）
+
+    返回:
+        list: 回退项，每项包含 corpus、config、baseline_mb_s、mb_s、change
+    """
+    baseline_index = {(r["corpus"], r["config"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        base = baseline_index.get((result["corpus"], result["config"]))
+        if not base or not base.get("mb_s"):
+            continue
+        change = (result["mb_s"] - base["mb_s"]) / base["mb_s"]
+        result["baseline_mb_s"] = base["mb_s"]
+        result["change"] = round(change, 4)
+        if change < -threshold:
+            regressions.append({
+                "corpus": result["corpus"],
+                "config": result["config"],
+                "baseline_mb_s": base["mb_s"],
+                "mb_s": result["mb_s"],
+                "change": result["change"],
+            })
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="KGM转换性能基准测试")
+    parser.add_argument("-o", "--output", default="bench_output.json", help="结果JSON文件")
+    parser.add_argument("--baseline", help="用于比较的基线JSON文件")
+    parser.add_argument("--save-baseline", help="把本次结果另存为基线")
+    parser.add_argument("--threshold", type=float, default=0.10, help="吞吐量下降超过该比例视为回退")
+    parser.add_argument("--repeat", type=int, default=3, help="每个配置运行的次数，取吞吐量中位数")
+    parser.add_argument("--scale", type=float, default=1.0, help="语料文件大小缩放系数")
+    parser.add_argument("--corpus", action="append", choices=sorted(CORPORA), help="只运行指定语料")
+    parser.add_argument("--config", action="append", choices=sorted(CONFIGS), help="只运行指定配置")
+    parser.add_argument("--quick", action="store_true", help="只运行常用配置")
+    parser.add_argument("--workdir", help="语料和输出目录（默认使用临时目录并在结束后删除）")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.run_one:
+        spec = json.loads(args.run_one)
+        print(json.dumps(run_one(spec["corpus_dir"], spec["output_dir"], spec["config"])))
+        return 0
+
+    corpora = args.corpus or sorted(CORPORA)
+    configs = args.config or (QUICK_CONFIGS if args.quick else sorted(CONFIGS))
+    workdir = args.workdir or tempfile.mkdtemp(prefix="kgm_bench_")
+
+    results = []
+    try:
+        for corpus in corpora:
+            corpus_dir = os.path.join(workdir, "corpus", corpus)
+            if not os.path.isdir(corpus_dir):
+                print(f"生成语料: {corpus}", file=sys.stderr)
+                generate_corpus(corpus_dir, CORPORA[corpus], args.scale)
+
+            for name in configs:
+                output_dir = os.path.join(workdir, "output", corpus, name)
+                print(f"运行: {corpus} / {name}", file=sys.stderr)
+                result = run_repeated(corpus_dir, output_dir, CONFIGS[name], args.repeat)
+                result.update({"corpus": corpus, "config": name})
+                results.append(result)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": kgm_core.np is not None,
+            "scale": args.scale,
+            "repeat": max(1, args.repeat),
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for result in results:
+        print(f"{result['corpus']:>6} {result['config']:<16} "
+              f"{result['mb_s']:>9.2f} MB/s {result['files_s']:>9.2f} 文件/s "
+              f"峰值内存 {result['peak_rss_kb']} KB (单进程 {result['max_process_rss_kb']} KB)")
+    for item in regressions:
+        print(f"性能回退: {item['corpus']} / {item['config']} "
+              f"{item['baseline_mb_s']} -> {item['mb_s']} MB/s ({item['change']:+.1%})")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
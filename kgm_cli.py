@@ -0,0 +1,187 @@
+"""
+KGM转换命令行入口（无图形界面）
+
+用法:
+    python -m kgm_cli 输入路径或通配符... -o 输出目录 [-j 进程数]
+
+每个文件完成后向标准输出写一行JSON进度，最后写一行汇总。
+"""
+import argparse
+import glob
+import json
+import os
+import signal
+import sys
+import time
+
+import kgm_core
+
+
+def expand_inputs(patterns):
+    """
+    展开输入路径、通配符和目录，返回去重后的 (真实路径, 文件大小) 列表
+
+    目录扫描时的大小来自目录项，不再逐个stat；显式给出的文件也解析为真实路径，
+    经软链接或不同写法重复给出的同一文件只转换一次。
+    """
+    files = []
+    seen = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) or [pattern]
+        for path in matches:
+            if os.path.isdir(path):
+                candidates = [item for batch in kgm_core.scan_kgm_files(path) for item in batch]
+            else:
+                path = os.path.realpath(path)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    # 不存在的文件仍然保留，转换时作为失败报告
+                    size = 0
+                candidates = [(path, size)]
+            for candidate, size in candidates:
+                if candidate not in seen:
+                    seen.add(candidate)
+                    files.append((candidate, size))
+    return files
+
+
+def emit(event, **fields):
+    """输出一行JSON"""
+    fields = {"event": event, **fields}
+    sys.stdout.write(json.dumps(fields, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="KGM转MP3命令行工具")
+    parser.add_argument("inputs", nargs="+", help="输入文件、目录或通配符")
+    parser.add_argument("-o", "--output-dir", required=True, help="输出目录")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="并行进程数")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="单进程流水线模式，读取、解密、写入重叠执行（适合机械硬盘）")
+    parser.add_argument("--durability", choices=kgm_core.DURABILITY_POLICIES, default="none",
+                        help="输出同步策略：none 不同步，batch 每N个文件同步一次，file 每个文件同步")
+    parser.add_argument("--sync-batch", type=int, default=64, help="batch 策略下每次同步的文件数")
+    parser.add_argument("--schedule", choices=kgm_core.SCHEDULING_POLICIES, default="fifo",
+                        help="调度顺序：fifo 按输入顺序，longest 大文件优先（总耗时最短），shortest 小文件优先")
+    parser.add_argument("--keep-partial", action="store_true",
+                        help="按 Ctrl+C 取消时保留未完成文件已写入的部分，下次运行从中断处继续")
+    parser.add_argument("--archive", choices=kgm_core.ARCHIVE_FORMATS,
+                        help="不写单独的文件，而是写入不压缩的 tar/zip 归档（每个进程一组分片）")
+    parser.add_argument("--archive-shard-size", type=int, default=0, metavar="MB",
+                        help="单个归档分片的大小上限（MB），0表示不分片")
+    parser.add_argument("--force", action="store_true", help="忽略转换清单，重新转换全部文件")
+    parser.add_argument("--hash", action="store_true", help="用内容摘要判断文件是否变化（修改时间变化但内容相同时跳过）")
+    parser.add_argument("--dedup", action="store_true",
+                        help="内容相同的输入只转换一次，其余输出用reflink/硬链接复用")
+    parser.add_argument("--progress-interval", type=float, default=0,
+                        help="每隔多少秒输出一行字节级进度，0表示不输出")
+    parser.add_argument("--memory-budget", type=int, default=0, metavar="MB",
+                        help="所有进程共享的在途缓冲区上限（MB），超出时进程等待，大文件自动分块流式处理；0表示不限制")
+    parser.add_argument("--trace", help="把每个文件的分阶段耗时追加写入该JSON Lines文件")
+    parser.add_argument("--metrics", help="把累计的分阶段耗时写成Prometheus文本格式快照")
+    parser.add_argument("--chunk-size", type=int, default=kgm_core.DEFAULT_CHUNK_SIZE, help="分块大小（字节）")
+    args = parser.parse_args(argv)
+    if args.archive and args.dedup:
+        parser.error("--archive 不能与 --dedup 同时使用")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = dict(expand_inputs(args.inputs))
+    files = list(sizes)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    manifest = None
+    skipped = 0
+    if not args.force:
+        manifest = kgm_core.ConversionManifest(args.output_dir, use_hash=args.hash)
+        pending = manifest.filter_jobs(files)
+        skipped = len(files) - len(pending)
+        files = pending
+
+    planned_bytes = sum(sizes[path] for path in files)
+    files = [path for path, _ in kgm_core.schedule_jobs([(path, sizes[path]) for path in files], args.schedule)]
+
+    dedup = None
+    jobs_files = files
+    if args.dedup:
+        dedup = kgm_core.DedupPlan.build((path, sizes[path]) for path in files)
+        jobs_files = dedup.unique
+
+    emit("start", files=len(files), skipped=skipped, workers=1 if args.pipeline else args.workers,
+         pipeline=args.pipeline, schedule=args.schedule, output_dir=args.output_dir,
+         duplicates=len(dedup.duplicates) if dedup else 0)
+
+    converted = 0
+    cancelled = 0
+    total_bytes = 0
+    failures = []
+    # 第一次 Ctrl+C 在分块边界取消在途文件并停止派发，再按一次则直接中断
+    control = kgm_core.ConversionControl(keep_partial=args.keep_partial)
+
+    def on_interrupt(signum, frame):
+        if control.cancelled:
+            raise KeyboardInterrupt
+        control.cancel()
+
+    signal.signal(signal.SIGINT, on_interrupt)
+    start_time = time.time()
+    metrics = kgm_core.StageMetrics(args.trace, args.metrics)
+
+    pool = kgm_core.ConversionPool(
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        want_hash=bool(manifest and args.hash),
+        pipeline=args.pipeline,
+        durability=args.durability,
+        sync_batch=args.sync_batch,
+        memory_budget=args.memory_budget * 1024 * 1024 or None,
+        archive=args.archive,
+        archive_shard_size=args.archive_shard_size * 1024 * 1024
+    )
+    try:
+        jobs = ((path, args.output_dir) for path in jobs_files)
+        on_sample = None
+        if args.progress_interval > 0:
+            on_sample = lambda sample: emit("progress", **sample)
+        for result in pool.run(jobs, on_sample=on_sample, total_bytes=planned_bytes,
+                               sample_interval=args.progress_interval or 0.5, dedup=dedup,
+                               schedule=[sizes[path] for path in jobs_files], control=control):
+            metrics.observe(result)
+            if result['cancelled']:
+                cancelled += 1
+            elif result['error']:
+                failures.append({"input": result['input'], "error": result['error']})
+            else:
+                converted += 1
+                total_bytes += result['size']
+                if manifest:
+                    manifest.record(result['input'], result['output'], result['hash'])
+            emit("file", **result)
+    finally:
+        metrics.close()
+        if manifest:
+            manifest.close()
+
+    seconds = time.time() - start_time
+    emit(
+        "summary",
+        files=converted,
+        skipped=skipped,
+        cancelled=cancelled,
+        bytes=total_bytes,
+        seconds=round(seconds, 3),
+        throughput=round(total_bytes / seconds, 1) if seconds > 0 else 0,
+        saved_bytes=pool.saved_bytes,
+        archive_prefix=pool.archive_prefix,
+        **metrics.summary(),
+        failures=failures
+    )
+    return 1 if failures or cancelled else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
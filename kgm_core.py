@@ -0,0 +1,2105 @@
+"""
+KGM转换核心模块
+
+不依赖图形界面，供 KGMConverterGUI 以及其他调用方共用。
+"""
+import ctypes
+import glob
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
+import multiprocessing.util
+import os
+import queue
+import secrets
+import shutil
+import signal
+import sqlite3
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import numpy as np
+except ImportError:  # numpy为可选依赖，缺失时退回 bytes.translate
+    np = None
+
+import kgm_formats
+
+# 默认分块大小（4MB），峰值内存只与分块大小有关，与文件大小无关
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 超过该大小的文件默认走内存映射路径（256MB）
+MMAP_THRESHOLD = 256 * 1024 * 1024
+
+# 输出同步策略：none 不主动同步；batch 每N个文件同步一次；file 每个文件重命名前同步
+DURABILITY_POLICIES = ('none', 'batch', 'file')
+
+# 进度板中每个工作进程槽位的字段：任务编号、已处理字节、文件总字节
+PROGRESS_FIELDS = 3
+
+# 任务调度策略：fifo 按选择顺序；longest 大文件优先（缩短多进程的总耗时）；
+# shortest 小文件优先（尽快看到完成的文件）
+SCHEDULING_POLICIES = ('fifo', 'longest', 'shortest')
+
+# 归档输出格式（均不压缩）
+ARCHIVE_FORMATS = ('tar', 'zip')
+
+# 本进程内归档运行的序号，用于生成不重复的分片名前缀
+_ARCHIVE_SEQUENCE = itertools.count(1)
+
+# 分阶段计时的阶段名：排队等待、打开、读取、解密、写入、关闭（提交）
+STAGES = ('queue', 'open', 'read', 'decrypt', 'write', 'close')
+
+
+def _lap(timings, stage, since):
+    """把从 since 到现在的耗时累加到 timings[stage]，返回当前时刻"""
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.0) + now - since
+    return now
+
+
+def convert_kgm_to_mp3(input_file, output_file, chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=None, digest=None,
+                       progress=None, writer=None, timings=None, control=None):
+    """
+    将KGM文件转换为MP3
+
+    参数:
+        input_file (str): 输入KGM文件路径
+        output_file (str): 输出MP3文件路径
+        chunk_size (int): 每次处理的字节数
+        use_mmap (bool): 是否使用内存映射；为None时按 MMAP_THRESHOLD 自动选择
+        digest: 可选的hashlib对象，转换时顺带用输入数据更新，避免再次读取文件
+        progress: 可选的进度槽位，每处理完一块写入已处理字节数，由调度方定期采样
+        writer (OutputWriter): 输出写入器，默认不做fsync
+        timings (dict): 可选，按 STAGES 中的阶段名累加耗时（秒）。内存映射方式下读取
+            发生在缺页时，计入 decrypt
+        control (ConversionControl): 可选，在每个分块边界检查暂停和取消，两种方式暂停时都会释放文件句柄。
+            control.keep_partial 为True时自动选择总是使用流式方式，因为只有它能保留已写入部分
+
+    返回:
+        int: 处理的字节数
+    """
+    if use_mmap is None:
+        use_mmap = ((control is None or not control.keep_partial)
+                    and os.path.getsize(input_file) >= MMAP_THRESHOLD)
+    if use_mmap:
+        return convert_kgm_to_mp3_mmap(input_file, output_file, chunk_size, digest, progress, writer, timings,
+                                       control)
+    return convert_kgm_to_mp3_stream(input_file, output_file, chunk_size, digest, progress, writer, timings,
+                                     control)
+
+
+def convert_kgm_to_mp3_stream(input_file, output_file, chunk_size=DEFAULT_CHUNK_SIZE, digest=None, progress=None,
+                              writer=None, timings=None, control=None):
+    """
+    以流式分块方式转换，峰值内存只与分块大小有关
+
+    给出 control 时，暂停期间关闭输入和输出文件句柄，继续后重新打开并定位；
+    取消时按 control.keep_partial 删除临时文件，或保留已写入部分，
+    下次转换同一文件时从保留的位置继续。
+    """
+    writer = writer or OutputWriter()
+    timings = {} if timings is None else timings
+    keep_partial = control is not None and control.keep_partial
+    mark = time.perf_counter()
+    src = open(input_file, 'rb')
+    dst = None
+    position = 0
+    try:
+        # 先根据文件头选择解码器，不支持的文件不会创建输出
+        header = src.read(kgm_formats.SNIFF_SIZE)
+        decoder = kgm_formats.sniff_decoder(header, input_file)
+        offset = decoder.payload_offset
+        if digest is not None:
+            digest.update(header[:offset])
+        st = os.fstat(src.fileno())
+        size = st.st_size
+        payload = max(size - offset, 0)
+        identity = OutputWriter.input_identity(st)
+
+        if keep_partial:
+            dst, position = writer.resume(output_file, identity, payload)
+        if dst is None:
+            dst = writer.open(output_file, payload)
+        src.seek(offset)
+        if position and digest is not None:
+            # 续传时已写入部分对应的输入也要计入摘要
+            remaining = position
+            while remaining > 0:
+                chunk = src.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+        else:
+            src.seek(offset + position)
+        total = offset + position
+        mark = _lap(timings, 'open', mark)
+
+        while True:
+            if control is not None:
+                if control.paused:
+                    # 暂停期间不占用文件句柄
+                    src.close()
+                    writer.suspend(dst)
+                    control.wait()
+                    src = open(input_file, 'rb')
+                    src.seek(offset + position)
+                    dst = writer.reopen(dst, position)
+                control.checkpoint()
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            mark = _lap(timings, 'read', mark)
+            plain = decoder.decrypt(chunk, position)
+            mark = _lap(timings, 'decrypt', mark)
+            dst.write(plain)
+            mark = _lap(timings, 'write', mark)
+            position += len(chunk)
+            total += len(chunk)
+            if progress is not None:
+                progress[1] = total
+    except ConversionCancelled:
+        if dst is not None:
+            if keep_partial:
+                writer.keep(dst, output_file, position, identity)
+            else:
+                writer.abort(dst, output_file)
+        raise
+    except BaseException:
+        if dst is not None:
+            writer.abort(dst, output_file)
+        raise
+    finally:
+        src.close()
+    writer.commit(dst, output_file, position)
+    _lap(timings, 'close', mark)
+
+    return total
+
+
+def convert_kgm_to_mp3_mmap(input_file, output_file, chunk_size=DEFAULT_CHUNK_SIZE, digest=None, progress=None,
+                            writer=None, timings=None, control=None):
+    """
+    以内存映射方式转换
+
+    输入只读映射，输出预先扩展到音频数据大小后可写映射，
+    数据直接在两个映射之间变换。有numpy时为零拷贝，否则每次只产生一个分块大小的临时对象。
+    给出 control 时在分块边界响应暂停和取消：暂停期间刷新并解除两个映射、关闭输入输出文件，
+    继续后重新打开并映射，从暂停的位置接着转换；取消时不保留已写入部分。
+    """
+    size = os.path.getsize(input_file)
+    if size == 0:
+        # 空文件无法映射
+        return convert_kgm_to_mp3_stream(input_file, output_file, chunk_size, digest, progress, writer, timings,
+                                         control)
+
+    writer = writer or OutputWriter()
+    timings = {} if timings is None else timings
+    mark = time.perf_counter()
+    src = open(input_file, 'rb')
+    dst = None
+    maps = {}
+
+    def map_files():
+        maps['src'] = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        if payload:
+            maps['dst'] = mmap.mmap(dst.fileno(), payload, access=mmap.ACCESS_WRITE)
+            if np is not None:
+                maps['src_arr'] = np.frombuffer(maps['src'], dtype=np.uint8)[offset:]
+                maps['dst_arr'] = np.frombuffer(maps['dst'], dtype=np.uint8)
+
+    def unmap_files():
+        # 先释放numpy对映射的引用，否则映射无法关闭
+        maps.pop('src_arr', None)
+        maps.pop('dst_arr', None)
+        dst_map = maps.pop('dst', None)
+        if dst_map is not None:
+            dst_map.flush()
+            dst_map.close()
+        src_map = maps.pop('src', None)
+        if src_map is not None:
+            src_map.close()
+
+    try:
+        decoder = kgm_formats.sniff_decoder(src.read(kgm_formats.SNIFF_SIZE), input_file)
+        offset = min(decoder.payload_offset, size)
+        payload = size - offset
+
+        dst = writer.open(output_file, payload, mode='w+b', extend=True)
+        map_files()
+        mark = _lap(timings, 'open', mark)
+        for start in range(0, payload, chunk_size):
+            if control is not None:
+                if control.paused:
+                    # 暂停期间不占用映射和文件句柄
+                    mark = _lap(timings, 'decrypt', mark)
+                    unmap_files()
+                    src.close()
+                    writer.suspend(dst)
+                    control.wait()
+                    src = open(input_file, 'rb')
+                    dst = writer.reopen(dst, 0)
+                    map_files()
+                    mark = time.perf_counter()
+                control.checkpoint()
+            end = min(start + chunk_size, payload)
+            if np is not None:
+                decoder.decrypt_into(maps['src_arr'][start:end], maps['dst_arr'][start:end], start)
+            else:
+                maps['dst'][start:end] = decoder.decrypt(maps['src'][offset + start:offset + end], start)
+            if progress is not None:
+                progress[1] = offset + end
+        mark = _lap(timings, 'decrypt', mark)
+        if digest is not None:
+            digest.update(maps['src'])
+            mark = _lap(timings, 'read', mark)
+        unmap_files()
+        mark = _lap(timings, 'write', mark)
+    except BaseException:
+        unmap_files()
+        if dst is not None:
+            writer.abort(dst, output_file)
+        raise
+    finally:
+        src.close()
+    writer.commit(dst, output_file)
+    _lap(timings, 'close', mark)
+
+    return size
+
+
+class ConversionCancelled(Exception):
+    """转换在分块边界被取消"""
+
+
+class ConversionControl:
+    """
+    可在进程间共享的暂停/取消开关
+
+    内部是两个共享内存中的标志（不带锁），经进程池初始化函数传给工作进程，
+    转换函数在每个分块边界检查，暂停和取消不必等当前文件转换完。不用
+    multiprocessing.Event 是因为它的读写都要加锁，工作进程在持锁时被杀掉
+    （如OOM）会让主进程和其余进程永远卡住。
+
+    参数:
+        keep_partial (bool): 取消时保留已写入的部分输出，下次转换同一文件时从该处继续
+    """
+
+    # 暂停期间检查标志的间隔（秒）
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, keep_partial=False):
+        self.keep_partial = keep_partial
+        self._paused = multiprocessing.Value(ctypes.c_bool, False, lock=False)
+        self._cancelled = multiprocessing.Value(ctypes.c_bool, False, lock=False)
+
+    @property
+    def paused(self):
+        return self._paused.value
+
+    @property
+    def cancelled(self):
+        return self._cancelled.value
+
+    def pause(self):
+        self._paused.value = True
+
+    def resume(self):
+        self._paused.value = False
+
+    def cancel(self):
+        self._cancelled.value = True
+        # 唤醒暂停中的任务，使其尽快结束
+        self._paused.value = False
+
+    def wait(self, timeout=None):
+        """等待继续（或取消），返回是否处于运行状态"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._paused.value:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.POLL_INTERVAL)
+        return True
+
+    def checkpoint(self):
+        """在分块边界调用：暂停时阻塞到继续，已取消时抛出 ConversionCancelled"""
+        if self._paused.value:
+            self.wait()
+        if self._cancelled.value:
+            raise ConversionCancelled("转换已取消")
+
+
+class OutputWriter:
+    """
+    输出文件写入器
+
+    先写入同目录下的隐藏临时文件，完成后原子重命名为最终文件名，中途失败不会留下
+    不完整的输出。临时文件名带随机后缀（.名称.XXXXXXXXXXXX.part），不同文件夹中
+    同名的输入同时转换时各写各的临时文件；之后的 commit/abort/suspend/reopen/keep
+    都通过 open 返回的文件对象的 name 找到它。打开时按预期大小预分配磁盘空间
+    （posix_fallocate），减少大量文件同时写入时的碎片。fsync 为True时在重命名前后分别同步文件和目录。
+
+    取消时保留的部分输出改名为 .名称.resume，长度等于已写入的字节数，旁边的
+    .名称.resume.id 记录当时输入文件的大小、修改时间和inode，只有完全一致才续传；
+    进程异常退出留下的 .part 文件长度可能是预分配的长度，因此不会用于续传。
+    """
+
+    def __init__(self, fsync=False):
+        self.fsync = fsync
+
+    @staticmethod
+    def temp_path(output_file):
+        """固定的临时文件名，供归档分片使用（分片名本身已按工作进程区分）"""
+        directory, name = os.path.split(output_file)
+        return os.path.join(directory, f".{name}.part")
+
+    @staticmethod
+    def create_temp(output_file, mode='wb'):
+        """在输出文件所在目录以独占方式创建唯一命名的临时文件，返回文件对象"""
+        directory, name = os.path.split(output_file)
+        mode = mode.replace('w', 'x')
+        while True:
+            path = os.path.join(directory, f".{name}.{secrets.token_hex(6)}.part")
+            try:
+                return open(path, mode)
+            except FileExistsError:
+                continue
+
+    @staticmethod
+    def remove_temps(output_file):
+        """删除 output_file 的所有临时文件（用于清理异常退出的进程留下的 .part）"""
+        directory, name = os.path.split(output_file)
+        pattern = os.path.join(glob.escape(directory), glob.escape(f".{name}.") + "*.part")
+        for path in glob.glob(pattern):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def resume_path(output_file):
+        directory, name = os.path.split(output_file)
+        return os.path.join(directory, f".{name}.resume")
+
+    @staticmethod
+    def identity_path(output_file):
+        return OutputWriter.resume_path(output_file) + ".id"
+
+    @staticmethod
+    def input_identity(st):
+        """由输入文件的 os.stat 结果得到其身份：大小、修改时间(ns)和inode"""
+        return f"{st.st_size} {st.st_mtime_ns} {st.st_ino}"
+
+    @staticmethod
+    def _remove_resume(output_file):
+        for path in (OutputWriter.resume_path(output_file), OutputWriter.identity_path(output_file)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def open(self, output_file, size=0, mode='wb', extend=False):
+        """
+        打开临时输出文件
+
+        参数:
+            size (int): 预期大小，用于预分配
+            extend (bool): 为True时保证文件长度等于 size（内存映射写入需要）
+        """
+        f = self.create_temp(output_file, mode)
+        try:
+            if size > 0:
+                preallocated = False
+                if hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, size)
+                        preallocated = True
+                    except OSError:
+                        # 部分文件系统（如某些网络文件系统）不支持预分配
+                        pass
+                if extend and not preallocated:
+                    f.truncate(size)
+        except BaseException:
+            self.abort(f, output_file)
+            raise
+        return f
+
+    def commit(self, f, output_file, length=None):
+        """
+        完成写入并重命名为最终文件
+
+        参数:
+            length (int): 实际写入的字节数，预分配的多余部分会被截掉
+        """
+        try:
+            if length is not None:
+                f.truncate(length)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.replace(f.name, output_file)
+        if self.fsync:
+            _fsync_directory(os.path.dirname(output_file))
+
+    def suspend(self, f):
+        """暂停时关闭临时文件，保留其内容"""
+        f.flush()
+        f.close()
+
+    def reopen(self, f, position):
+        """继续时重新打开 suspend 关闭的临时文件 f，定位到已写入的位置"""
+        f = open(f.name, 'r+b')
+        f.seek(position)
+        return f
+
+    def keep(self, f, output_file, length, identity):
+        """取消时保留已写入的 length 字节，连同输入文件身份 identity 一起，供下次续传"""
+        try:
+            f.truncate(length)
+            f.flush()
+        finally:
+            f.close()
+        # 先删掉旧的保留文件，再写身份、最后改名，中途中断也不会让新身份配上旧数据
+        self._remove_resume(output_file)
+        try:
+            with open(self.identity_path(output_file), 'w', encoding='ascii') as id_file:
+                id_file.write(identity)
+        except BaseException:
+            self.abort(f, output_file)
+            raise
+        os.replace(f.name, self.resume_path(output_file))
+
+    def resume(self, output_file, identity, size):
+        """
+        打开上次取消时保留的部分输出继续写入
+
+        .resume.id 中记录的输入身份与 identity 不完全一致（输入已被替换，哪怕大小相同）、
+        缺少身份记录或保留文件比音频数据还长时，视为无效并删除。
+
+        返回:
+            tuple: (文件对象, 已写入字节数)；没有可续传的部分输出时为 (None, 0)
+        """
+        path = self.resume_path(output_file)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, 0
+        try:
+            with open(self.identity_path(output_file), encoding='ascii') as id_file:
+                saved = id_file.read()
+        except (OSError, ValueError):
+            saved = None
+        if st.st_size > size or saved != identity:
+            self._remove_resume(output_file)
+            return None, 0
+        f = self.create_temp(output_file)
+        f.close()
+        os.replace(path, f.name)
+        self._remove_resume(output_file)
+        return self.reopen(f, st.st_size), st.st_size
+
+    def abort(self, f, output_file):
+        """放弃写入并删除临时文件"""
+        try:
+            f.close()
+        finally:
+            try:
+                os.remove(f.name)
+            except OSError:
+                pass
+
+
+def _fsync_directory(directory):
+    """同步目录项，使重命名持久化（Windows不支持对目录fsync，直接跳过）"""
+    if os.name == 'nt':
+        return
+    fd = os.open(directory or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_files(paths):
+    """批量同步已写完的文件及其所在目录"""
+    directories = set()
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(path))
+    for directory in directories:
+        _fsync_directory(directory)
+
+
+class ArchiveSink:
+    """
+    归档输出：把转换结果直接追加到不压缩的 tar 或 zip 归档中
+
+    提供与 OutputWriter 相同的 open/commit/abort 等方法，可直接作为转换函数的 writer。
+    每个文件只是归档中的一个成员，目标目录里不再逐个创建、关闭文件，适合向网络共享
+    写入大量小文件。分片写入时使用 .名称.part 临时文件，close 时才重命名为最终文件名；
+    当前分片超过 shard_size 字节后，下一个成员写入新的分片。
+
+    失败或取消的成员会从归档中截掉，不会留下不完整的成员；暂停时分片句柄保持打开。
+    同一个分片只能由一个线程或进程写入，多进程时每个工作进程使用自己的分片。
+    同一分片中成员名重复（不同目录下的同名文件）时，后来的成员改名为 名称 (n).扩展名。
+
+    参数:
+        prefix (str): 分片文件名前缀，分片名为 前缀-序号.扩展名，放在第一个成员的输出目录中
+        fmt (str): ARCHIVE_FORMATS 之一
+        shard_size (int): 单个分片的大小上限（字节），0表示不分片
+        fsync (bool): 关闭分片时是否同步文件和目录
+    """
+
+    def __init__(self, prefix, fmt='tar', shard_size=0, fsync=False):
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f"未知的归档格式: {fmt}")
+        self.prefix = prefix
+        self.fmt = fmt
+        self.shard_size = shard_size
+        self.fsync = fsync
+        self.paths = []
+        self._shard_index = 0
+        self._path = None
+        self._fp = None
+        self._zip = None
+        self._member = None
+        self._names = set()
+        self._last_name = None
+
+    def _open_shard(self, directory):
+        # 跳过已存在的分片名，不覆盖之前运行留下的归档
+        while True:
+            self._path = os.path.join(directory, f"{self.prefix}-{self._shard_index:03d}.{self.fmt}")
+            self._shard_index += 1
+            if not os.path.exists(self._path):
+                break
+        self._names = set()
+        self._fp = open(OutputWriter.temp_path(self._path), 'w+b')
+        if self.fmt == 'zip':
+            self._zip = zipfile.ZipFile(self._fp, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def _close_shard(self):
+        if self._fp is None:
+            return
+        try:
+            if self._zip is not None:
+                # 写入中央目录，不会关闭底层文件
+                self._zip.close()
+            else:
+                # 归档结尾为两个全零块，并补齐到记录大小
+                end = self._fp.tell() + 2 * tarfile.BLOCKSIZE
+                self._fp.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE + (-end % tarfile.RECORDSIZE)))
+            self._fp.flush()
+            if self.fsync:
+                os.fsync(self._fp.fileno())
+        finally:
+            self._fp.close()
+            self._fp = self._zip = None
+        os.replace(OutputWriter.temp_path(self._path), self._path)
+        if self.fsync:
+            _fsync_directory(os.path.dirname(self._path))
+        self.paths.append(self._path)
+
+    def member_path(self):
+        """最近提交的成员在结果中显示的路径：分片路径/成员名"""
+        return os.path.join(self._path, self._last_name)
+
+    def _member_name(self, output_file):
+        """返回当前分片中尚未使用的成员名"""
+        name = os.path.basename(output_file)
+        stem, ext = os.path.splitext(name)
+        index = 1
+        while name in self._names:
+            name = f"{stem} ({index}){ext}"
+            index += 1
+        self._names.add(name)
+        return name
+
+    def open(self, output_file, size=0, mode='wb', extend=False):
+        """在归档中开始一个成员，成员名为 output_file 的文件名，size 为预期大小"""
+        if self._fp is not None and self.shard_size and self._fp.tell() >= self.shard_size:
+            self._close_shard()
+        if self._fp is None:
+            self._open_shard(os.path.dirname(output_file))
+
+        name = self._member_name(output_file)
+        start = self._fp.tell()
+        if self._zip is not None:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = size
+            f = self._zip.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(time.time())
+            info.mode = 0o644
+            self._fp.write(info.tobuf(tarfile.PAX_FORMAT))
+            f = self._fp
+        self._member = (info, start, self._fp.tell(), f)
+        return f
+
+    def commit(self, f, output_file, length=None):
+        """完成当前成员；tar 格式下实际长度与预期不同时改写成员头"""
+        info, start, data_start, _ = self._member
+        if self._zip is not None:
+            f.close()
+        else:
+            end = self._fp.tell()
+            actual = end - data_start
+            if actual != info.size:
+                info.size = actual
+                header = info.tobuf(tarfile.PAX_FORMAT)
+                if len(header) != data_start - start:
+                    self.abort(f, output_file)
+                    raise OSError(f"归档成员长度变化，无法改写成员头: {info.name}")
+                self._fp.seek(start)
+                self._fp.write(header)
+                self._fp.seek(end)
+            self._fp.write(tarfile.NUL * (-actual % tarfile.BLOCKSIZE))
+        self._last_name = info.name if self._zip is None else info.filename
+        self._member = None
+
+    def abort(self, f, output_file):
+        """放弃当前成员，把分片截回成员开始前的位置"""
+        if self._member is None:
+            return
+        info, start, _, _ = self._member
+        self._member = None
+        self._names.discard(info.name if self._zip is None else info.filename)
+        if self._zip is not None:
+            f.close()
+            self._zip.filelist.remove(info)
+            self._zip.NameToInfo.pop(info.filename, None)
+            # start_dir 是中央目录的写入位置，截掉成员后要一并回退
+            self._zip.start_dir = start
+        self._fp.seek(start)
+        self._fp.truncate()
+
+    def suspend(self, f):
+        """暂停时只刷新缓冲区，分片句柄在成员之间共用，不关闭"""
+        f.flush()
+
+    def reopen(self, f, position):
+        return self._member[3]
+
+    def keep(self, f, output_file, length, identity):
+        """归档中不保留不完整的成员"""
+        self.abort(f, output_file)
+
+    def resume(self, output_file, identity, size):
+        return None, 0
+
+    def close(self):
+        """放弃未完成的成员并关闭当前分片"""
+        if self._member is not None:
+            self.abort(self._member[3], None)
+        self._close_shard()
+
+
+def build_output_path(input_file, output_dir):
+    """根据输入文件构建输出MP3路径"""
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(input_file))[0] + '.mp3')
+
+
+def _new_result(input_file, output_file):
+    """创建转换结果字典"""
+    return {
+        'input': input_file,
+        'output': output_file,
+        'size': 0,
+        'seconds': 0.0,
+        'worker': os.getpid(),
+        'hash': None,
+        'dedup_of': None,
+        'cancelled': False,
+        'stages': dict.fromkeys(STAGES, 0.0),
+        'error': None
+    }
+
+
+class MemoryBudget:
+    """
+    所有工作进程共享的在途内存预算（字节）
+
+    用 multiprocessing 的 Condition 和共享计数实现，可在进程间和线程间共用。
+    acquire 在剩余额度不足时阻塞；单次申请超过总额时按总额计，
+    等其他占用全部释放后放行，不会永久阻塞。
+    """
+
+    def __init__(self, limit):
+        if limit <= 0:
+            raise ValueError("内存预算必须大于0")
+        self.limit = int(limit)
+        self._used = multiprocessing.Value(ctypes.c_longlong, 0, lock=False)
+        self._cond = multiprocessing.Condition()
+
+    @property
+    def used(self):
+        return self._used.value
+
+    def acquire(self, nbytes):
+        """
+        申请 nbytes 字节额度，不足时等待
+
+        返回:
+            int: 实际占用的额度，释放时原样传给 release
+        """
+        nbytes = min(max(int(nbytes), 0), self.limit)
+        with self._cond:
+            self._cond.wait_for(lambda: self._used.value + nbytes <= self.limit)
+            self._used.value += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        if not nbytes:
+            return
+        with self._cond:
+            self._used.value -= nbytes
+            self._cond.notify_all()
+
+
+# 当前工作进程在进度板中的槽位，由 _init_worker 设置
+_progress_slot = None
+
+# 当前工作进程使用的内存预算及每个进程的份额，由 _init_worker 设置
+_memory_budget = None
+_memory_share = 0
+
+# 当前工作进程使用的暂停/取消开关，由 _init_worker 设置
+_control = None
+
+# 当前工作进程的归档分片（归档输出模式），由 _init_worker 创建
+_archive_sink = None
+
+
+def _init_worker(board, slot_counter, budget=None, share=0, control=None, archive=None):
+    """
+    工作进程初始化：领取一个进度板槽位，记录共享的内存预算和暂停/取消开关
+
+    参数:
+        archive (tuple): 归档输出模式下为 (分片前缀, 格式, 分片大小, 是否fsync)，
+            每个工作进程写自己的分片，进程退出时关闭
+    """
+    global _progress_slot, _memory_budget, _memory_share, _control, _archive_sink
+    _memory_budget = budget
+    _memory_share = share
+    _control = control
+    if control is not None:
+        # 终端的 Ctrl+C 会发给整个进程组，由主进程通过 control 统一取消
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with slot_counter.get_lock():
+        index = slot_counter.value
+        slot_counter.value += 1
+    slot_type = ctypes.c_longlong * PROGRESS_FIELDS
+    _progress_slot = slot_type.from_buffer(board, index * ctypes.sizeof(slot_type))
+    _progress_slot[0] = -1
+    if archive is not None:
+        prefix, fmt, shard_size, fsync = archive
+        _archive_sink = ArchiveSink(f"{prefix}-w{index:02d}", fmt, shard_size, fsync)
+        # 进程池关闭时工作进程正常退出，退出前写完归档结尾并重命名分片
+        multiprocessing.util.Finalize(_archive_sink, _archive_sink.close, exitpriority=10)
+
+
+def _committed_slot(job_id):
+    """进度板槽位中表示“job_id 已完成输出、结果尚未送回”的值（小于-1，不会被当作在途任务）"""
+    return -2 - job_id
+
+
+def convert_job(input_file, output_dir, chunk_size=DEFAULT_CHUNK_SIZE, want_hash=False, job_id=-1, use_mmap=None,
+                fsync=False, submitted=None):
+    """
+    在工作进程中执行单个转换任务
+
+    参数:
+        submitted (float): 提交任务时的 time.time()，用于计算排队等待时间
+
+    设置了内存预算时，先按本文件需要的缓冲区大小申请额度（等待额度的时间计入 queue）：
+    仍按配置的分块大小流式处理，读入和解密输出各占一块，申请两倍的
+    min(文件大小, 分块大小)；分块大小超过本进程份额的一半时才缩小到份额的一半。
+    此时不使用内存映射（映射的页面不受预算控制），除非显式指定 use_mmap。
+
+    返回:
+        dict: 包含 input、output、size、seconds、worker、hash、stages、error 的结果字典，
+        异常不会抛出，而是记录在 error 中
+    """
+    output_file = build_output_path(input_file, output_dir)
+    result = _new_result(input_file, output_file)
+    if submitted is not None:
+        result['stages']['queue'] = max(0.0, time.time() - submitted)
+    digest = new_digest() if want_hash else None
+    progress = _progress_slot
+    budget = _memory_budget
+    reserved = 0
+    start = time.perf_counter()
+    try:
+        size = os.path.getsize(input_file)
+        if budget is not None:
+            share = max(_memory_share, 2)
+            # 读入和解密输出各占一块缓冲区，分块超过份额一半时才缩小
+            chunk_size = min(chunk_size, share // 2)
+            if use_mmap is None:
+                use_mmap = False
+            mark = time.perf_counter()
+            reserved = budget.acquire(2 * min(max(size, 1), chunk_size))
+            _lap(result['stages'], 'queue', mark)
+        if progress is not None:
+            progress[1] = 0
+            progress[2] = size
+            progress[0] = job_id
+        writer = _archive_sink or OutputWriter(fsync)
+        result['size'] = convert_kgm_to_mp3(input_file, output_file, chunk_size,
+                                            use_mmap=False if _archive_sink else use_mmap,
+                                            digest=digest, progress=progress, writer=writer,
+                                            timings=result['stages'], control=_control)
+        if progress is not None:
+            # 输出已完成；进程在送回结果前被杀掉时，调度方据此判断不必重转
+            progress[0] = _committed_slot(job_id)
+        if _archive_sink is not None:
+            result['output'] = _archive_sink.member_path()
+        if digest is not None:
+            result['hash'] = digest.hexdigest()
+    except ConversionCancelled as e:
+        result['error'] = str(e)
+        result['cancelled'] = True
+    except Exception as e:
+        result['error'] = f"转换失败: {str(e)}"
+    finally:
+        if reserved:
+            budget.release(reserved)
+        # 先清空槽位再返回结果，避免调度方重复计算字节数
+        if progress is not None:
+            progress[0] = -1
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+class PipelineExecutor:
+    """
+    读取、解密、写入三段流水线
+
+    三个阶段各占一个线程，阶段之间用有界队列连接：读取线程在写入当前文件的同时
+    预读后续文件的数据块，使磁盘I/O与解密计算重叠。适合机械硬盘等多进程并发
+    反而导致频繁寻道的场合。提供与 ProcessPoolExecutor 相同的 submit 接口，
+    返回的 Future 在文件写完时完成。
+
+    指定 budget（MemoryBudget）时，读取线程每读一块前申请该块的额度，
+    写入线程写完（或丢弃）该块后释放，预读的数据总量不会超过预算。
+
+    指定 control（ConversionControl）时，读取线程在分块边界响应暂停和取消，
+    暂停期间读取和写入线程都关闭各自的文件句柄。取消时当前文件的部分输出
+    按 control.keep_partial 删除或保留（流水线模式本身不从保留的部分续传）。
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, depth=8, progress=None, fsync=False, budget=None,
+                 control=None, writer=None):
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.budget = budget
+        self.control = control
+        # writer 可以是 ArchiveSink，此时所有输出写入同一个归档
+        self.output_writer = writer or OutputWriter(fsync)
+        self._jobs = queue.Queue()
+        self._read_queue = queue.Queue(maxsize=depth)
+        self._write_queue = queue.Queue(maxsize=depth)
+        self._threads = [
+            threading.Thread(target=self._reader, daemon=True),
+            threading.Thread(target=self._decrypter, daemon=True),
+            threading.Thread(target=self._writer, daemon=True)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, input_file, output_dir, chunk_size=None, want_hash=False, job_id=-1, use_mmap=None,
+               fsync=False, submitted=None):
+        """提交一个转换任务（fn 仅为与进程池接口保持一致，不会被调用）"""
+        future = Future()
+        # 各阶段线程分别把自己的耗时累加到同一个字典的不同键上
+        stages = dict.fromkeys(STAGES, 0.0)
+        self._jobs.put((future, input_file, output_dir, want_hash, job_id, submitted or time.time(), stages))
+        return future
+
+    def shutdown(self, wait=True):
+        self._jobs.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+            if isinstance(self.output_writer, ArchiveSink):
+                self.output_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        return False
+
+    def _reader(self):
+        """读取阶段：逐块读取输入文件"""
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._read_queue.put(None)
+                return
+            future, input_file, output_dir, want_hash, job_id, submitted, stages = job
+            stages['queue'] = max(0.0, time.time() - submitted)
+            digest = new_digest() if want_hash else None
+            control = self.control
+            if control is not None and control.cancelled:
+                self._read_queue.put(('cancel', job, None))
+                continue
+            mark = time.perf_counter()
+            src = None
+            try:
+                src = open(input_file, 'rb')
+                size = os.fstat(src.fileno()).st_size
+                # 只读文件头即可选定解码器，不支持的文件不会创建输出
+                header = src.read(kgm_formats.SNIFF_SIZE)
+                decoder = kgm_formats.sniff_decoder(header, input_file)
+                if digest is not None:
+                    digest.update(header[:decoder.payload_offset])
+                src.seek(decoder.payload_offset)
+                mark = _lap(stages, 'open', mark)
+                self._read_queue.put(('start', job, (size, decoder)))
+                while True:
+                    if control is not None:
+                        if control.paused:
+                            # 暂停期间不占用输入文件句柄
+                            position = src.tell()
+                            src.close()
+                            control.wait()
+                            src = open(input_file, 'rb')
+                            src.seek(position)
+                        control.checkpoint()
+                    mark = time.perf_counter()
+                    reserved = self.budget.acquire(self.chunk_size) if self.budget is not None else 0
+                    _lap(stages, 'queue', mark)
+                    mark = time.perf_counter()
+                    chunk = src.read(self.chunk_size)
+                    if not chunk:
+                        if self.budget is not None:
+                            self.budget.release(reserved)
+                        break
+                    if digest is not None:
+                        digest.update(chunk)
+                    _lap(stages, 'read', mark)
+                    self._read_queue.put(('data', job, (chunk, reserved)))
+                self._read_queue.put(('end', job, digest.hexdigest() if digest is not None else None))
+            except ConversionCancelled:
+                self._read_queue.put(('cancel', job, None))
+            except Exception as e:
+                self._read_queue.put(('error', job, f"转换失败: {str(e)}"))
+            finally:
+                if src is not None:
+                    src.close()
+
+    def _decrypter(self):
+        """
+        解密阶段：变换数据块，其他消息原样转发
+
+        解密出错时改为向写入线程发送 error 消息，并丢弃该文件后续的全部消息。
+        """
+        decoder = None
+        position = 0
+        failed = None
+        while True:
+            message = self._read_queue.get()
+            if message is not None:
+                kind, job, payload = message
+                if kind == 'start':
+                    decoder = payload[1]
+                    position = 0
+                    failed = None
+                elif job is failed:
+                    if kind == 'data' and self.budget is not None:
+                        self.budget.release(payload[1])
+                    continue
+                elif kind == 'data':
+                    chunk, reserved = payload
+                    mark = time.perf_counter()
+                    try:
+                        message = ('data', job, (decoder.decrypt(chunk, position), reserved))
+                    except Exception as e:
+                        failed = job
+                        if self.budget is not None:
+                            self.budget.release(reserved)
+                        message = ('error', job, f"转换失败: {str(e)}")
+                    _lap(job[6], 'decrypt', mark)
+                    position += len(chunk)
+            self._write_queue.put(message)
+            if message is None:
+                return
+
+    def _writer(self):
+        """写入阶段：写出数据块并完成对应的 Future"""
+        dst = None
+        result = None
+        current = None
+        start = 0
+        written = 0
+        suspended = None
+        progress = self.progress
+        writer = self.output_writer
+        control = self.control
+        while True:
+            try:
+                message = self._write_queue.get(timeout=0.2 if control is not None else None)
+            except queue.Empty:
+                # 暂停且已写完收到的数据块：关闭输出文件句柄，收到后续消息时再打开
+                if dst is not None and control.paused:
+                    writer.suspend(dst)
+                    suspended = dst
+                    dst = None
+                continue
+            if message is None:
+                return
+            kind, job, payload = message
+            future, input_file, output_dir, _, job_id, _, stages = job
+
+            if suspended is not None and current is job:
+                try:
+                    dst = writer.reopen(suspended, written)
+                except Exception as e:
+                    result['error'] = f"转换失败: {str(e)}"
+                suspended = None
+
+            if kind == 'start':
+                current = job
+                size, decoder = payload
+                result = _new_result(input_file, build_output_path(input_file, output_dir))
+                result['size'] = min(decoder.payload_offset, size)
+                start = time.perf_counter()
+                if progress is not None:
+                    progress[1] = result['size']
+                    progress[2] = size
+                    progress[0] = job_id
+                written = 0
+                mark = time.perf_counter()
+                try:
+                    dst = writer.open(result['output'], max(size - decoder.payload_offset, 0))
+                except Exception as e:
+                    result['error'] = f"转换失败: {str(e)}"
+                _lap(stages, 'open', mark)
+                continue
+
+            if current is not job:
+                # 读取阶段在打开文件前就失败，没有收到 start 消息
+                current = job
+                result = _new_result(input_file, build_output_path(input_file, output_dir))
+                start = time.perf_counter()
+
+            if kind == 'data':
+                chunk, reserved = payload
+                if dst is not None and result['error'] is None:
+                    mark = time.perf_counter()
+                    try:
+                        dst.write(chunk)
+                        written += len(chunk)
+                        result['size'] += len(chunk)
+                        if progress is not None:
+                            progress[1] = result['size']
+                    except Exception as e:
+                        result['error'] = f"转换失败: {str(e)}"
+                    _lap(stages, 'write', mark)
+                if self.budget is not None:
+                    self.budget.release(reserved)
+                continue
+
+            # end、error 或 cancel：收尾并完成 Future
+            if kind == 'error':
+                result['error'] = payload
+            elif kind == 'cancel':
+                result['error'] = result['error'] or "转换已取消"
+                result['cancelled'] = True
+            elif result['error'] is None:
+                result['hash'] = payload
+            if dst is not None:
+                mark = time.perf_counter()
+                try:
+                    if result['error'] is None:
+                        writer.commit(dst, result['output'], written)
+                        if isinstance(writer, ArchiveSink):
+                            result['output'] = writer.member_path()
+                    elif result['cancelled'] and control.keep_partial:
+                        identity = OutputWriter.input_identity(os.stat(input_file))
+                        writer.keep(dst, result['output'], written, identity)
+                    else:
+                        writer.abort(dst, result['output'])
+                except Exception as e:
+                    result['error'] = result['error'] or f"转换失败: {str(e)}"
+                _lap(stages, 'close', mark)
+                dst = None
+            if progress is not None:
+                progress[0] = -1
+            result['seconds'] = time.perf_counter() - start
+            result['stages'] = stages
+            future.set_result(result)
+            current = result = None
+
+
+def schedule_jobs(entries, policy='fifo'):
+    """
+    按调度策略排列任务
+
+    参数:
+        entries (list): (路径, 大小) 元组
+        policy (str): SCHEDULING_POLICIES 之一
+
+    返回:
+        list: 排列后的 (路径, 大小) 元组，大小相同时保持原有顺序
+    """
+    if policy not in SCHEDULING_POLICIES:
+        raise ValueError(f"未知的调度策略: {policy}")
+    if policy == 'longest':
+        return sorted(entries, key=lambda entry: entry[1], reverse=True)
+    if policy == 'shortest':
+        return sorted(entries, key=lambda entry: entry[1])
+    return list(entries)
+
+
+def estimate_makespan(pending_sizes, workers, in_flight=()):
+    """
+    模拟贪心分配：按顺序把每个任务交给最早空闲的进程
+
+    参数:
+        pending_sizes (iterable): 尚未派发的任务大小，按派发顺序
+        workers (int): 进程数
+        in_flight (iterable): 各进程当前任务的剩余字节数
+
+    返回:
+        int: 最后一个进程完成时它处理的字节数，除以单进程速度即为剩余时间
+    """
+    loads = sorted(in_flight, reverse=True)[:workers]
+    loads += [0] * (workers - len(loads))
+    heapq.heapify(loads)
+    for size in pending_sizes:
+        heapq.heapreplace(loads, loads[0] + size)
+    return max(loads) if loads else 0
+
+
+class ProgressSampler:
+    """
+    根据定期采样的已处理字节数计算瞬时速度、滑动平均速度和剩余时间
+
+    给出 schedule（按派发顺序的任务大小列表）时，剩余时间按调度顺序模拟各进程的
+    分配情况来估算，能反映末尾大文件导致其他进程空闲的情况；否则按总字节数估算。
+    """
+
+    def __init__(self, total_bytes=0, alpha=0.3, schedule=None, workers=1):
+        self.total_bytes = total_bytes
+        self.schedule = schedule
+        self.workers = workers
+        self.alpha = alpha
+        self.avg_rate = 0.0
+        self._last_bytes = 0
+        self._last_time = None
+
+    def sample(self, bytes_done, now=None, dispatched=0, in_flight=()):
+        """
+        记录一次采样
+
+        参数:
+            dispatched (int): 已派发的任务数，schedule 中此后的任务尚未开始
+            in_flight (list): 在途任务的剩余字节数
+
+        返回:
+            dict: bytes_done、total_bytes、rate（瞬时速度）、avg_rate（滑动平均速度）、
+            eta（按字节估算的剩余秒数，无法估算时为None）
+        """
+        now = time.time() if now is None else now
+        rate = 0.0
+        if self._last_time is not None and now > self._last_time:
+            rate = max(0, bytes_done - self._last_bytes) / (now - self._last_time)
+            self.avg_rate = rate if not self.avg_rate else self.alpha * rate + (1 - self.alpha) * self.avg_rate
+        self._last_bytes = bytes_done
+        self._last_time = now
+
+        eta = None
+        if self.schedule is not None and self.avg_rate > 0:
+            # 总速度按当前忙碌的进程数平分，得到单进程速度
+            busy = max(1, min(self.workers, len(in_flight)))
+            remaining = estimate_makespan(self.schedule[dispatched:], self.workers, in_flight)
+            eta = remaining / (self.avg_rate / busy)
+        elif self.total_bytes and self.avg_rate > 0:
+            eta = max(0, self.total_bytes - bytes_done) / self.avg_rate
+
+        return {
+            'bytes_done': bytes_done,
+            'total_bytes': self.total_bytes,
+            'rate': rate,
+            'avg_rate': self.avg_rate,
+            'eta': eta
+        }
+
+
+class StageMetrics:
+    """
+    分阶段耗时统计
+
+    汇总每个结果字典中的 stages，可选地把每个文件写成一行JSON（trace_path），
+    并定期把累计值写成Prometheus文本格式快照（prometheus_path，可供 node_exporter
+    的 textfile 采集器读取）。快照先写临时文件再重命名，采集方不会读到半个文件。
+
+    参数:
+        trace_path (str): JSON Lines 跟踪文件路径，为None时不写
+        prometheus_path (str): Prometheus 快照文件路径，为None时不写
+        interval (float): 快照的最短写入间隔（秒），close 时总会再写一次
+    """
+
+    # 单文件总耗时直方图的桶上限（秒）
+    BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 120.0)
+
+    # 计入磁盘I/O的阶段，其余（decrypt）为CPU
+    IO_STAGES = ('open', 'read', 'write', 'close')
+
+    def __init__(self, trace_path=None, prometheus_path=None, interval=5.0):
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+        self.file_seconds = 0.0
+        self.buckets = [0] * len(self.BUCKETS)
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self._next_write = 0
+        self._lock = threading.Lock()
+        self._trace = open(trace_path, 'a', encoding='utf-8', buffering=1) if trace_path else None
+
+    def observe(self, result):
+        """记录一个结果字典"""
+        stages = result.get('stages') or {}
+        with self._lock:
+            if result['error']:
+                self.failed += 1
+            else:
+                self.files += 1
+                self.bytes += result['size']
+            for stage, seconds in stages.items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            self.file_seconds += result['seconds']
+            for index, bound in enumerate(self.BUCKETS):
+                if result['seconds'] <= bound:
+                    self.buckets[index] += 1
+            if self._trace is not None:
+                self._trace.write(json.dumps({
+                    'ts': round(time.time(), 6),
+                    'input': result['input'],
+                    'output': result['output'],
+                    'size': result['size'],
+                    'worker': result['worker'],
+                    'seconds': result['seconds'],
+                    'stages': stages,
+                    'error': result['error']
+                }, ensure_ascii=False) + '\n')
+        if self.prometheus_path and time.time() >= self._next_write:
+            self.write_prometheus()
+
+    def summary(self):
+        """
+        返回各阶段累计耗时，以及判断瓶颈的 bound（'disk' 或 'cpu'，无数据时为None）
+        """
+        io_seconds = sum(self.stage_seconds[stage] for stage in self.IO_STAGES)
+        cpu_seconds = self.stage_seconds['decrypt']
+        bound = None
+        if io_seconds or cpu_seconds:
+            bound = 'disk' if io_seconds >= cpu_seconds else 'cpu'
+        return {
+            'stages': {stage: round(seconds, 6) for stage, seconds in self.stage_seconds.items()},
+            'bound': bound
+        }
+
+    def prometheus_text(self):
+        """生成Prometheus文本格式的快照内容"""
+        lines = [
+            "# HELP kgm_stage_seconds_total Time spent in each conversion stage.",
+            "# TYPE kgm_stage_seconds_total counter",
+        ]
+        for stage, seconds in self.stage_seconds.items():
+            lines.append(f'kgm_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}')
+        lines += [
+            "# HELP kgm_files_total Files processed, by outcome.",
+            "# TYPE kgm_files_total counter",
+            f'kgm_files_total{{status="converted"}} {self.files}',
+            f'kgm_files_total{{status="failed"}} {self.failed}',
+            "# HELP kgm_bytes_total Input bytes converted.",
+            "# TYPE kgm_bytes_total counter",
+            f"kgm_bytes_total {self.bytes}",
+            "# HELP kgm_file_seconds Wall time per converted file.",
+            "# TYPE kgm_file_seconds histogram",
+        ]
+        for bound, count in zip(self.BUCKETS, self.buckets):
+            lines.append(f'kgm_file_seconds_bucket{{le="{bound}"}} {count}')
+        total = self.files + self.failed
+        lines += [
+            f'kgm_file_seconds_bucket{{le="+Inf"}} {total}',
+            f"kgm_file_seconds_sum {self.file_seconds:.6f}",
+            f"kgm_file_seconds_count {total}",
+            "# HELP kgm_metrics_timestamp_seconds Time this snapshot was written.",
+            "# TYPE kgm_metrics_timestamp_seconds gauge",
+            f"kgm_metrics_timestamp_seconds {time.time():.3f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """把快照原子地写入 prometheus_path"""
+        if not self.prometheus_path:
+            return
+        with self._lock:
+            text = self.prometheus_text()
+            self._next_write = time.time() + self.interval
+        temp = self.prometheus_path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp, self.prometheus_path)
+
+    def close(self):
+        self.write_prometheus()
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
+
+# 任务迭代器结束的标记，与表示“暂时没有任务”的None区分
+_NO_MORE_JOBS = object()
+
+
+class ConversionPool:
+    """
+    多进程转换池
+
+    解密在独立进程中进行，不受GIL限制。调度线程按需从任务源取任务，
+    同时在途的任务数不超过进程数的两倍，以便暂停和取消能尽快生效。
+
+    每个工作进程在共享的进度板上占一个槽位，逐块写入已处理字节数；
+    调度线程按固定间隔采样，而不是每处理一块就回调一次。
+
+    pipeline 为True时不启动进程，改用单个 PipelineExecutor 流水线，
+    最多预读 PIPELINE_PREFETCH 个文件。
+
+    输出经 OutputWriter 预分配并原子重命名，durability 取值见 DURABILITY_POLICIES。
+
+    memory_budget 为所有工作进程共享的在途缓冲区字节数上限（见 MemoryBudget），
+    为None时不限制。
+
+    archive 为 ARCHIVE_FORMATS 之一时不写单独的文件，而是写入不压缩的归档（见 ArchiveSink）：
+    每个工作进程写自己的分片（流水线模式只有一组分片），分片名以 archive_prefix 开头，
+    超过 archive_shard_size 字节后换下一个分片。结果中的 output 为“分片路径/成员名”。
+    """
+
+    PIPELINE_PREFETCH = 4
+
+    def __init__(self, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, want_hash=False, pipeline=False,
+                 use_mmap=None, durability='none', sync_batch=64, memory_budget=None, archive=None,
+                 archive_shard_size=0):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError(f"未知的同步策略: {durability}")
+        if archive is not None and archive not in ARCHIVE_FORMATS:
+            raise ValueError(f"未知的归档格式: {archive}")
+        self.workers = 1 if pipeline else max(1, workers or os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self.use_mmap = use_mmap
+        self.durability = durability
+        self.sync_batch = sync_batch
+        self.want_hash = want_hash
+        self.pipeline = pipeline
+        self.memory_budget = memory_budget
+        self.archive = archive
+        self.archive_shard_size = archive_shard_size
+        self.archive_prefix = None
+        self.pause_time = 0.0
+        self.completed_bytes = 0
+        self.saved_bytes = 0
+        self._board = None
+        self._job_inputs = {}
+
+    def snapshot(self):
+        """
+        读取进度板
+
+        返回:
+            tuple: (已处理总字节数, [(输入文件, 已处理字节, 文件总字节), ...])
+        """
+        in_flight = []
+        bytes_done = self.completed_bytes
+        if self._board is not None:
+            for index in range(0, len(self._board), PROGRESS_FIELDS):
+                job_id, done, total = self._board[index:index + PROGRESS_FIELDS]
+                input_file = self._job_inputs.get(job_id)
+                if job_id >= 0 and input_file is not None:
+                    in_flight.append((input_file, done, total))
+                    bytes_done += done
+        return bytes_done, in_flight
+
+    def _link_duplicate(self, result, duplicate, dedup):
+        """为重复输入生成输出：直接链接到已转换文件，而不是再解密一次"""
+        output_file = build_output_path(duplicate, os.path.dirname(result['output']))
+        linked = _new_result(duplicate, output_file)
+        linked['dedup_of'] = result['input']
+        if result['error']:
+            linked['error'] = result['error']
+            return linked
+        try:
+            if os.path.abspath(output_file) != os.path.abspath(result['output']):
+                link_output(result['output'], output_file)
+            linked['size'] = dedup.size(duplicate)
+            self.saved_bytes += linked['size']
+        except Exception as e:
+            linked['error'] = f"转换失败: {str(e)}"
+        return linked
+
+    def run(self, jobs, pause_event=None, is_cancelled=None, on_sample=None, total_bytes=0,
+            sample_interval=0.5, dedup=None, schedule=None, control=None):
+        """
+        执行一批转换任务，按完成顺序逐个产出结果字典
+
+        参数:
+            jobs (iterable): (input_file, output_dir) 元组，按需惰性读取；
+                产出None表示暂时没有任务（如监视目录时），稍后会再次读取，迭代结束才视为全部派发完
+            pause_event (threading.Event): 未设置时暂停派发新任务
+            is_cancelled (function): 返回True时停止派发，已在途的任务会继续完成
+            on_sample (function): 每隔 sample_interval 秒以采样结果字典调用一次，
+                额外包含 files（在途文件的 (输入文件, 已处理字节, 总字节) 列表）
+            total_bytes (int): 本批次总字节数，用于估算剩余时间
+            dedup (DedupPlan): 去重计划；jobs 中只应包含其 unique 文件。原文件转换时顺带计算
+                完整摘要，完成后为摘要一致的重复项链接输出并产出对应结果（dedup_of 指向原文件），
+                摘要不一致的候选随后单独转换
+            schedule (list): 与 jobs 顺序一致的文件大小列表，用于按调度顺序估算剩余时间
+            control (ConversionControl): 暂停/取消开关，在途任务也在分块边界响应；
+                被取消的任务产出的结果中 cancelled 为True
+        """
+        jobs = iter(jobs)
+        exhausted = False
+        pending = {}
+        pause_start = 0
+        next_job_id = 0
+        next_sample = 0
+        self.pause_time = 0.0
+        self.completed_bytes = 0
+        self.saved_bytes = 0
+        self._job_inputs = {}
+        self._board = multiprocessing.RawArray(ctypes.c_longlong, self.workers * PROGRESS_FIELDS)
+        for index in range(0, len(self._board), PROGRESS_FIELDS):
+            self._board[index] = -1
+        sampler = ProgressSampler(total_bytes, schedule=schedule, workers=self.workers)
+        fsync = self.durability == 'file'
+        # batch 策略：由调度方每 sync_batch 个文件统一同步一次
+        unsynced = [] if self.durability == 'batch' and not self.archive else None
+
+        archive = None
+        if self.archive:
+            if dedup is not None:
+                raise ValueError("归档输出不支持去重链接")
+            # 归档按分片整体同步，任何同步策略下都在关闭分片时同步
+            # 时间只精确到秒，加上进程号和序号，同一秒内的多次运行不会写到同一组分片
+            self.archive_prefix = f"{time.strftime('kgm-%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_ARCHIVE_SEQUENCE)}"
+            archive = (self.archive_prefix, self.archive, self.archive_shard_size, self.durability != 'none')
+
+        budget = MemoryBudget(self.memory_budget) if self.memory_budget else None
+
+        def process_pool(budget, archive):
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self._board, multiprocessing.Value('i', 0), budget,
+                          budget.limit // self.workers if budget is not None else 0, control, archive)
+            )
+
+        if self.pipeline:
+            slot_type = ctypes.c_longlong * PROGRESS_FIELDS
+            chunk_size = min(self.chunk_size, budget.limit) if budget is not None else self.chunk_size
+            executor = PipelineExecutor(chunk_size, progress=slot_type.from_buffer(self._board),
+                                        fsync=fsync, budget=budget, control=control,
+                                        writer=ArchiveSink(*archive) if archive else None)
+            max_in_flight = self.PIPELINE_PREFETCH
+        else:
+            executor = process_pool(budget, archive)
+            max_in_flight = self.workers * 2
+        # 工作进程异常退出（如被OOM杀掉）时整个进程池失效：等所有进程退出后按进度板
+        # 区分各任务，正在转换的记为失败并清理临时文件，已完成输出的照常产出结果，
+        # 还没开始的换一个新进程池重新派发
+        broken = None
+        restarts = 0
+        requeued = []
+
+        def deliver(result, job):
+            """产出一个任务的结果，以及由它确认的重复项的结果"""
+            nonlocal unsynced
+            results = [result]
+            if dedup is not None:
+                same, different = dedup.resolve(result['input'], None if result['error'] else result['hash'])
+                results += [self._link_duplicate(result, dup, dedup) for dup in same]
+                requeued.extend((path, job[1]) for path in different)
+            for result in results:
+                self.completed_bytes += result['size']
+                if unsynced is not None and result['error'] is None:
+                    unsynced.append(result['output'])
+                    if len(unsynced) >= self.sync_batch:
+                        sync_files(unsynced)
+                        unsynced = []
+                yield result
+
+        try:
+            while True:
+                cancelled = bool(is_cancelled and is_cancelled()) or bool(control and control.cancelled)
+                paused = bool(pause_event and not pause_event.is_set()) or bool(control and control.paused)
+
+                # 记录暂停时长，供速度统计扣除
+                if paused and not pause_start:
+                    pause_start = time.time()
+                elif not paused and pause_start:
+                    self.pause_time += time.time() - pause_start
+                    pause_start = 0
+
+                if broken is not None and not pending:
+                    # 等管理线程回收崩溃进程池的所有进程，进度板不再变化后再判断各任务的状态，
+                    # 临时文件也在这之后删除，新进程池的任务不会被误删
+                    executor.shutdown()
+                    slots = self._board[0::PROGRESS_FIELDS]
+                    recovered = []
+                    for job_id, job in broken:
+                        result = _new_result(job[0], build_output_path(*job))
+                        if job_id in slots:
+                            result['error'] = "转换失败: 工作进程异常退出"
+                            OutputWriter.remove_temps(result['output'])
+                        elif _committed_slot(job_id) in slots and archive is None:
+                            # 最终文件已写完并改名，只是结果没来得及送回
+                            try:
+                                result['size'] = os.path.getsize(job[0])
+                                if self.want_hash or (dedup is not None and dedup.needs_digest(job[0])):
+                                    result['hash'] = file_digest(job[0])
+                            except OSError as e:
+                                result['error'] = f"转换失败: {str(e)}"
+                        else:
+                            # 还没有进程领取，或已完成但结果没送回（归档成员随崩溃的分片一起作废）
+                            requeued.append(job)
+                            continue
+                        recovered.append((result, job))
+                    broken = None
+                    restarts += 1
+                    for index in range(0, len(self._board), PROGRESS_FIELDS):
+                        self._board[index] = -1
+                    # 死掉的进程可能占着预算额度或锁，换用新的预算；归档分片换用新名称，不覆盖旧分片
+                    budget = MemoryBudget(self.memory_budget) if self.memory_budget else None
+                    if archive is not None:
+                        archive = (f"{self.archive_prefix}-r{restarts}",) + archive[1:]
+                    executor = process_pool(budget, archive)
+                    for result, job in recovered:
+                        yield from deliver(result, job)
+
+                while (not (cancelled or paused or broken is not None) and (requeued or not exhausted)
+                       and len(pending) < max_in_flight):
+                    job = requeued.pop() if requeued else next(jobs, _NO_MORE_JOBS)
+                    if job is _NO_MORE_JOBS:
+                        exhausted = True
+                        break
+                    if job is None:
+                        break
+                    try:
+                        want_hash = self.want_hash or (dedup is not None and dedup.needs_digest(job[0]))
+                        future = executor.submit(convert_job, *job, self.chunk_size, want_hash, next_job_id,
+                                                 self.use_mmap, fsync, time.time())
+                    except BrokenProcessPool:
+                        requeued.append(job)
+                        if broken is None:
+                            broken = []
+                        break
+                    pending[future] = (next_job_id, job)
+                    self._job_inputs[next_job_id] = job[0]
+                    next_job_id += 1
+
+                if on_sample and time.time() >= next_sample:
+                    next_sample = time.time() + sample_interval
+                    bytes_done, in_flight = self.snapshot()
+                    # 已提交但还没有进程领取的任务仍算作未开始
+                    started = next_job_id - (len(pending) - len(in_flight))
+                    sample = sampler.sample(bytes_done, dispatched=started,
+                                            in_flight=[total - done for _, done, total in in_flight])
+                    sample['files'] = in_flight
+                    on_sample(sample)
+
+                if not pending:
+                    if broken is not None:
+                        continue
+                    if (exhausted and not requeued) or cancelled:
+                        break
+                    if pause_event is not None and paused:
+                        pause_event.wait(0.1)
+                    else:
+                        time.sleep(0.1)
+                    continue
+
+                done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id, job = pending.pop(future)
+                    self._job_inputs.pop(job_id, None)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        if broken is None:
+                            broken = []
+                        broken.append((job_id, job))
+                        continue
+                    except Exception as e:
+                        result = _new_result(job[0], build_output_path(job[0], job[1]))
+                        result['error'] = f"转换失败: {str(e) or type(e).__name__}"
+                    yield from deliver(result, job)
+        finally:
+            executor.shutdown()
+
+        if unsynced:
+            sync_files(unsynced)
+        if pause_start:
+            self.pause_time += time.time() - pause_start
+
+
+def new_digest():
+    """创建用于内容摘要的hashlib对象"""
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """计算文件内容的摘要（十六进制）"""
+    digest = new_digest()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConversionManifest:
+    """
+    转换清单，记录已成功转换的文件，保存在输出目录中的SQLite数据库里
+
+    以输入文件的绝对路径为键，记录大小、修改时间和可选的内容摘要。
+    大小和修改时间都未变化且输出文件仍存在时视为无需转换；
+    启用 use_hash 时，即使修改时间变化，只要内容摘要一致也会跳过。
+    """
+
+    FILENAME = ".kgm_manifest.sqlite3"
+
+    def __init__(self, output_dir, use_hash=False, commit_interval=500):
+        self.output_dir = output_dir
+        self.use_hash = use_hash
+        self.commit_interval = commit_interval
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(output_dir, self.FILENAME), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS converted ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT, output TEXT)"
+        )
+        # 一次性载入全部记录，之后的查询都在内存中完成
+        self._entries = {
+            row[0]: row[1:]
+            for row in self._conn.execute("SELECT path, size, mtime_ns, hash, output FROM converted")
+        }
+
+    def needs_conversion(self, input_file):
+        """判断输入文件是否为新文件或已变化"""
+        path = os.path.abspath(input_file)
+        entry = self._entries.get(path)
+        if entry is None:
+            return True
+
+        size, mtime_ns, digest, output = entry
+        # 归档输出记录为“分片路径/成员名”，检查分片是否存在
+        if not os.path.exists(output) and not os.path.isfile(os.path.dirname(output)):
+            return True
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return True
+        if st.st_size != size:
+            return True
+        if st.st_mtime_ns == mtime_ns:
+            return False
+        if self.use_hash and digest:
+            return file_digest(path) != digest
+        return True
+
+    def filter_jobs(self, input_files):
+        """返回需要转换的文件列表，保持原有顺序"""
+        return [path for path in input_files if self.needs_conversion(path)]
+
+    def record(self, input_file, output_file, digest=None):
+        """
+        记录一个成功转换的文件，digest 为转换时顺带计算的内容摘要
+
+        输入文件在转换后已被移走或删除时不记录（下次遇到时重新转换），不抛出异常。
+        """
+        path = os.path.abspath(input_file)
+        try:
+            st = os.stat(path)
+            if self.use_hash and digest is None:
+                digest = file_digest(path)
+        except OSError:
+            return
+        entry = (st.st_size, st.st_mtime_ns, digest, os.path.abspath(output_file))
+
+        with self._lock:
+            self._entries[path] = entry
+            self._conn.execute(
+                "INSERT OR REPLACE INTO converted (path, size, mtime_ns, hash, output) VALUES (?, ?, ?, ?, ?)",
+                (path,) + entry
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_interval:
+                self._conn.commit()
+                self._uncommitted = 0
+
+    def close(self):
+        """提交未保存的记录并关闭数据库"""
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+class FileStore:
+    """
+    待转换文件的有序集合
+
+    按添加顺序保存文件路径，成员判断和删除都是O(1)。
+    删除只留下空位，在下次按位置访问时统一压缩，批量删除的总开销为O(n)。
+    扫描时已知的文件大小一并保存，规划和进度统计无需再次stat。
+    """
+
+    def __init__(self):
+        self._items = []
+        self._index = {}
+        self._sizes = {}
+        self._holes = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, path):
+        return path in self._index
+
+    def __iter__(self):
+        return (path for path in self._items if path is not None)
+
+    def __getitem__(self, position):
+        self._compact()
+        return self._items[position]
+
+    def add(self, path, size=None):
+        """添加文件，已存在时返回False"""
+        if path in self._index:
+            return False
+        self._index[path] = len(self._items)
+        self._items.append(path)
+        if size is not None:
+            self._sizes[path] = size
+        return True
+
+    def add_many(self, paths):
+        """批量添加文件，返回实际新增的数量"""
+        return sum(1 for path in paths if self.add(path))
+
+    def add_entries(self, entries):
+        """批量添加 (路径, 大小) 条目，返回实际新增的数量"""
+        return sum(1 for path, size in entries if self.add(path, size))
+
+    def size(self, path):
+        """返回文件大小，扫描时未记录的才调用stat"""
+        size = self._sizes.get(path)
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return 0
+            self._sizes[path] = size
+        return size
+
+    def remove(self, path):
+        """删除文件，不存在时返回False"""
+        position = self._index.pop(path, None)
+        if position is None:
+            return False
+        self._items[position] = None
+        self._sizes.pop(path, None)
+        self._holes += 1
+        return True
+
+    def remove_many(self, paths):
+        """批量删除文件，返回实际删除的数量"""
+        return sum(1 for path in paths if self.remove(path))
+
+    def window(self, start, count):
+        """返回从 start 开始的最多 count 个文件，用于只渲染可见行"""
+        self._compact()
+        return self._items[start:start + count]
+
+    def clear(self):
+        self._items.clear()
+        self._index.clear()
+        self._sizes.clear()
+        self._holes = 0
+
+    def _compact(self):
+        """清除删除留下的空位并重建位置索引"""
+        if not self._holes:
+            return
+        self._items = [path for path in self._items if path is not None]
+        self._index = {path: position for position, path in enumerate(self._items)}
+        self._holes = 0
+
+
+def _scan_directory(path, extensions):
+    """扫描单个目录，返回 (匹配的 (真实路径, 大小) 列表, 子目录列表)"""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(extensions) and entry.is_file():
+                        # scandir在大多数平台上已缓存stat结果
+                        files.append((os.path.realpath(entry.path), entry.stat().st_size))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def scan_kgm_files(roots, workers=8, batch_size=500, extensions=kgm_formats.SUPPORTED_EXTENSIONS):
+    """
+    并发扫描目录树，分批产出 (真实路径, 文件大小) 列表
+
+    每个目录作为一个任务提交给线程池，子目录一经发现就并发扫描，
+    适合NFS等高延迟文件系统。按真实路径去重，软链接形成的环和重复目录只扫描一次。
+    """
+    if isinstance(roots, str):
+        roots = [roots]
+    extensions = tuple(ext.lower() for ext in extensions)
+    seen_dirs = set()
+    seen_files = set()
+    batch = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for root in roots:
+            real = os.path.realpath(root)
+            if real not in seen_dirs:
+                seen_dirs.add(real)
+                pending.add(executor.submit(_scan_directory, root, extensions))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for subdir in subdirs:
+                    real = os.path.realpath(subdir)
+                    if real not in seen_dirs:
+                        seen_dirs.add(real)
+                        pending.add(executor.submit(_scan_directory, subdir, extensions))
+                for path, size in files:
+                    if path not in seen_files:
+                        seen_files.add(path)
+                        batch.append((path, size))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+    if batch:
+        yield batch
+
+
+# 去重时先比较文件首尾各一段的摘要，只有部分摘要相同的文件才计算完整摘要
+_PARTIAL_DIGEST_SIZE = 64 * 1024
+
+
+def _partial_digest(path, size):
+    """计算文件首尾两段的摘要，用于快速排除大小相同但内容不同的文件"""
+    digest = new_digest()
+    with open(path, 'rb') as f:
+        digest.update(f.read(_PARTIAL_DIGEST_SIZE))
+        if size > 2 * _PARTIAL_DIGEST_SIZE:
+            f.seek(size - _PARTIAL_DIGEST_SIZE)
+            digest.update(f.read(_PARTIAL_DIGEST_SIZE))
+    return digest.hexdigest()
+
+
+class DedupPlan:
+    """
+    输入去重计划
+
+    按大小分组，只对大小相同的文件计算首尾部分摘要；首尾摘要也相同的一组中第一个作为
+    原文件转换，转换时顺带计算完整摘要，其余候选预先计算完整摘要（原文件不会被读两遍）。
+    原文件转换完成后由 resolve 确认：完整摘要一致的重复项链接输出，不一致的单独转换。
+    """
+
+    def __init__(self):
+        self.unique = []
+        self.duplicates = {}
+        self._groups = {}
+        self._sizes = {}
+        self._digests = {}
+
+    @classmethod
+    def build(cls, entries):
+        """
+        根据 (路径, 大小) 条目生成去重计划，保持原有顺序
+
+        参数:
+            entries (iterable): (路径, 大小) 元组，大小为None时调用stat
+        """
+        plan = cls()
+        by_size = {}
+        ordered = []
+        for path, size in entries:
+            if size is None:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    size = -1
+            plan._sizes[path] = size
+            ordered.append(path)
+            by_size.setdefault(size, []).append(path)
+
+        canonical = {}
+        for size, paths in by_size.items():
+            if len(paths) < 2 or size <= 0:
+                continue
+            groups = {}
+            for path in paths:
+                try:
+                    key = _partial_digest(path, size)
+                except OSError:
+                    continue
+                groups.setdefault(key, []).append(path)
+            for group in groups.values():
+                for path in group[1:]:
+                    try:
+                        plan._digests[path] = file_digest(path)
+                    except OSError:
+                        continue
+                    canonical[path] = group[0]
+
+        for path in ordered:
+            original = canonical.get(path)
+            if original is None:
+                plan.unique.append(path)
+            else:
+                plan.duplicates[path] = original
+                plan._groups.setdefault(original, []).append(path)
+        return plan
+
+    def needs_digest(self, path):
+        """path 是否有待确认的重复项，转换时需要顺带计算完整摘要"""
+        return path in self._groups
+
+    def duplicates_of(self, path):
+        """返回以 path 为原文件、尚待确认的重复项"""
+        return self._groups.get(path, [])
+
+    def resolve(self, path, digest):
+        """
+        原文件转换完成后确认其重复项
+
+        完整摘要不一致的候选按摘要重新分组，每组第一个需要单独转换，其余成为它的重复项。
+
+        参数:
+            digest (str): 原文件转换时计算的完整摘要；转换失败时为None，此时全部候选
+                都作为重复项返回，由调用方标记为同样失败
+
+        返回:
+            tuple: (可直接链接输出的重复项列表, 需要单独转换的文件列表)
+        """
+        candidates = self._groups.pop(path, [])
+        if digest is None:
+            return candidates, []
+        same = []
+        regrouped = {}
+        for candidate in candidates:
+            if self._digests.get(candidate) == digest:
+                same.append(candidate)
+            else:
+                regrouped.setdefault(self._digests.get(candidate), []).append(candidate)
+        different = []
+        for group in regrouped.values():
+            original = group[0]
+            del self.duplicates[original]
+            different.append(original)
+            for candidate in group[1:]:
+                self.duplicates[candidate] = original
+            if len(group) > 1:
+                self._groups[original] = group[1:]
+        return same, different
+
+    def size(self, path):
+        return max(self._sizes.get(path, 0), 0)
+
+    @property
+    def duplicate_bytes(self):
+        """重复项的总字节数，即去重可节省的解密量"""
+        return sum(self.size(path) for path in self.duplicates)
+
+
+def _reflink(src, dst):
+    """在支持的文件系统（Btrfs、XFS等）上创建写时复制副本，不支持时抛出OSError"""
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def link_output(src, dst):
+    """
+    把已转换的输出复用到另一个路径
+
+    依次尝试写时复制（reflink）、硬链接，最后退回普通复制。
+    先链接到临时名再原子重命名，不会留下不完整的目标文件。
+    """
+    f = OutputWriter.create_temp(dst)
+    f.close()
+    temp = f.name
+    try:
+        try:
+            if os.name == 'nt':
+                raise OSError("reflink不可用")
+            _reflink(src, temp)
+        except (OSError, ImportError):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            try:
+                os.link(src, temp)
+            except OSError:
+                shutil.copyfile(src, temp)
+        os.replace(temp, dst)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,393 @@
+"""
+监视目录，自动转换新放入的KGM文件（常驻服务模式）
+
+用法:
+    python main.py --watch 投放目录 [--watch 投放目录2 ...] -o 输出目录 [-j 进程数]
+
+Linux下使用inotify获得文件事件，其他平台或inotify不可用时退回定时扫描。
+文件的大小和修改时间在 --settle 秒内不再变化才视为写入完成，避免转换复制到一半的文件。
+待转换队列有上限，队列满时暂缓入队，已发现的文件留在跟踪表中稍后再入队。
+每个文件完成后向标准输出写一行JSON，收到 SIGINT/SIGTERM 时处理完在途文件后退出。
+"""
+import argparse
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+
+import kgm_core
+from kgm_cli import emit
+from kgm_formats import SUPPORTED_EXTENSIONS
+
+# inotify 事件掩码（见 <sys/inotify.h>）
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _is_candidate(path):
+    return path.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def _walk_files(root):
+    """递归列出目录下待转换的文件"""
+    for batch in kgm_core.scan_kgm_files([root]):
+        for path, _ in batch:
+            yield path
+
+
+class InotifyWatcher:
+    """
+    基于inotify的目录监视（通过ctypes调用libc，无需额外依赖）
+
+    递归监视所有子目录，新建或移入的子目录会自动加入监视，其中已有的文件也会报告。
+    """
+
+    def __init__(self, roots):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("当前系统不支持inotify")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1失败")
+        self._dirs = {}
+        self.roots = list(roots)
+        self._pending = []
+        for root in self.roots:
+            self._add_tree(root)
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"无法监视目录: {directory}")
+        self._dirs[wd] = directory
+
+    def _add_tree(self, root):
+        """监视 root 及其所有子目录，并报告其中已有的文件"""
+        for directory, subdirs, _ in os.walk(root):
+            try:
+                self._add_watch(directory)
+            except OSError:
+                subdirs[:] = []
+        self._pending.extend(_walk_files(root))
+
+    def rescan(self):
+        """事件队列溢出时重新列出全部文件"""
+        for root in self.roots:
+            self._pending.extend(_walk_files(root))
+
+    def poll(self, timeout):
+        """
+        等待文件事件
+
+        参数:
+            timeout (float): 最长等待秒数
+        返回:
+            list: 发生变化的候选文件路径
+        """
+        changed, self._pending = self._pending, []
+        if changed:
+            timeout = 0
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.rescan()
+                continue
+            directory = self._dirs.get(wd)
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+            elif _is_candidate(path):
+                changed.append(path)
+        changed += self._pending
+        self._pending = []
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """
+    定时扫描目录的监视器，inotify不可用时使用
+
+    每次扫描比较文件的大小和修改时间，报告新增或变化的文件。
+    """
+
+    def __init__(self, roots, interval=2.0):
+        self.roots = list(roots)
+        self.interval = interval
+        self._known = {}
+        self._next_scan = 0
+
+    def rescan(self):
+        self._known = {}
+        self._next_scan = 0
+
+    def poll(self, timeout):
+        now = time.monotonic()
+        if now < self._next_scan:
+            time.sleep(min(timeout, self._next_scan - now))
+            return []
+        self._next_scan = now + self.interval
+
+        changed = []
+        seen = {}
+        for root in self.roots:
+            for path in _walk_files(root):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                state = (st.st_size, st.st_mtime_ns)
+                seen[path] = state
+                if self._known.get(path) != state:
+                    changed.append(path)
+        self._known = seen
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(roots, polling=False, interval=2.0):
+    """优先使用inotify，不可用时退回定时扫描"""
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(roots, interval)
+
+
+class StabilityTracker:
+    """
+    判断文件是否写入完成
+
+    记录每个候选文件最近一次的大小和修改时间，在 settle 秒内都没有变化才视为稳定。
+    稳定的文件仍留在跟踪表中，入队成功后由调用方 discard，队列满时下一轮再取。
+    """
+
+    def __init__(self, settle=2.0):
+        self.settle = settle
+        self._candidates = {}
+
+    def __len__(self):
+        return len(self._candidates)
+
+    def touch(self, path, now=None):
+        """收到文件事件时调用，重新开始计时"""
+        now = time.monotonic() if now is None else now
+        self._candidates[path] = (None, now)
+
+    def discard(self, path):
+        """不再跟踪该文件（已入队或无需转换）"""
+        self._candidates.pop(path, None)
+
+    def ready(self, now=None):
+        """检查所有候选文件，返回已稳定的文件（不移除，见 discard）"""
+        now = time.monotonic() if now is None else now
+        stable = []
+        for path, (state, since) in list(self._candidates.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._candidates[path]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != state:
+                self._candidates[path] = (current, now)
+            elif now - since >= self.settle:
+                stable.append(path)
+        return stable
+
+
+class WatchService:
+    """
+    监视服务：监视线程发现稳定的文件后放入有界队列，调度线程交给 ConversionPool 转换
+
+    参数:
+        roots (list): 投放目录
+        output_dir (str): 输出目录
+        workers (int): 并行进程数
+        queue_size (int): 待转换队列上限
+        settle (float): 文件大小和修改时间保持不变多少秒后才开始转换
+        polling (bool): 强制使用定时扫描
+        interval (float): 定时扫描的间隔秒数
+        trace_path (str): 分阶段耗时的JSON Lines跟踪文件
+        metrics_path (str): Prometheus文本格式快照文件
+        memory_budget (int): 所有进程共享的在途缓冲区字节数上限
+    """
+
+    def __init__(self, roots, output_dir, workers=None, queue_size=256, settle=2.0, polling=False,
+                 interval=2.0, durability='none', trace_path=None, metrics_path=None, memory_budget=None):
+        self.roots = [os.path.realpath(root) for root in roots]
+        self.output_dir = output_dir
+        self.workers = workers
+        self.durability = durability
+        self.memory_budget = memory_budget
+        self.metrics = kgm_core.StageMetrics(trace_path, metrics_path)
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.tracker = StabilityTracker(settle)
+        self.polling = polling
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.manifest = None
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _enqueue(self, path):
+        """放入有界队列，不等待；队列满时返回False"""
+        with self._queued_lock:
+            if path in self._queued:
+                return True
+        if not self.manifest.needs_conversion(path):
+            return True
+        try:
+            self.jobs.put_nowait((path, self.output_dir))
+        except queue.Full:
+            return False
+        with self._queued_lock:
+            self._queued.add(path)
+        return True
+
+    def watch_loop(self, watcher):
+        """
+        监视线程：收集文件事件，等文件稳定后入队
+
+        队列满时不阻塞，其余稳定文件留在跟踪表中下一轮再入队，
+        监视线程始终及时读取文件事件，inotify 队列不会因此溢出。
+        """
+        try:
+            while not self.stop_event.is_set():
+                for path in watcher.poll(0.5):
+                    self.tracker.touch(os.path.realpath(path))
+                for path in self.tracker.ready():
+                    if not self._enqueue(path):
+                        break
+                    self.tracker.discard(path)
+        finally:
+            watcher.close()
+
+    def iter_jobs(self):
+        """供 ConversionPool.run 读取的任务流，暂时没有文件时产出None，服务停止时结束"""
+        while not self.stop_event.is_set():
+            try:
+                yield self.jobs.get_nowait()
+            except queue.Empty:
+                yield None
+
+    def run(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.manifest = kgm_core.ConversionManifest(self.output_dir)
+        watcher = create_watcher(self.roots, self.polling, self.interval)
+        watch_thread = threading.Thread(target=self.watch_loop, args=(watcher,), daemon=True)
+        watch_thread.start()
+        emit("watch", roots=self.roots, output_dir=self.output_dir,
+             backend="inotify" if isinstance(watcher, InotifyWatcher) else "polling",
+             queue_size=self.jobs.maxsize)
+
+        pool = kgm_core.ConversionPool(workers=self.workers, durability=self.durability,
+                                       memory_budget=self.memory_budget)
+        failures = 0
+        try:
+            for result in pool.run(self.iter_jobs(), is_cancelled=self.stop_event.is_set):
+                self.metrics.observe(result)
+                if result['error']:
+                    failures += 1
+                else:
+                    self.manifest.record(result['input'], result['output'], result['hash'])
+                with self._queued_lock:
+                    self._queued.discard(result['input'])
+                emit("file", **result)
+        finally:
+            self.stop_event.set()
+            watch_thread.join()
+            self.metrics.close()
+            self.manifest.close()
+        emit("stopped", failures=failures)
+        return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="监视目录并自动转换KGM文件")
+    parser.add_argument("--watch", action="append", required=True, metavar="DIR", help="投放目录，可重复指定")
+    parser.add_argument("-o", "--output-dir", required=True, help="输出目录")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="并行进程数")
+    parser.add_argument("--queue-size", type=int, default=256, help="待转换队列上限")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="文件大小和修改时间保持不变多少秒后才开始转换")
+    parser.add_argument("--poll", action="store_true", help="不使用inotify，改为定时扫描")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="定时扫描的间隔秒数")
+    parser.add_argument("--durability", choices=kgm_core.DURABILITY_POLICIES, default="none",
+                        help="输出同步策略")
+    parser.add_argument("--memory-budget", type=int, default=0, metavar="MB",
+                        help="所有进程共享的在途缓冲区上限（MB），0表示不限制")
+    parser.add_argument("--trace", help="把每个文件的分阶段耗时追加写入该JSON Lines文件")
+    parser.add_argument("--metrics", help="定期把累计的分阶段耗时写成Prometheus文本格式快照")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    service = WatchService(
+        args.watch,
+        args.output_dir,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        settle=args.settle,
+        polling=args.poll,
+        interval=args.poll_interval,
+        durability=args.durability,
+        trace_path=args.trace,
+        metrics_path=args.metrics,
+        memory_budget=args.memory_budget * 1024 * 1024 or None
+    )
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: service.stop())
+    service.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
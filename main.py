@@ -1,10 +1,122 @@
 import os
+import sys
 import threading
-from queue import Queue
+from queue import Queue, Empty
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
+import tkinter.font
 import time
-import gc
+import multiprocessing
+from collections import deque
+
+import kgm_core
+
+# 界面刷新间隔（毫秒），后台线程的事件在此节奏下批量处理
+UI_FRAME_INTERVAL = 50
+
+# 状态信息框最多保留的行数
+MAX_STATUS_LINES = 1000
+
+# 输出方式及其界面显示名称，None 表示每个文件单独写出
+OUTPUT_LABELS = (
+    (None, "单独文件"),
+    ("tar", "tar归档"),
+    ("zip", "zip归档"),
+)
+
+# 调度策略及其界面显示名称
+SCHEDULE_LABELS = (
+    ("fifo", "按添加顺序"),
+    ("longest", "大文件优先"),
+    ("shortest", "小文件优先"),
+)
+
+class VirtualFileList(ttk.Frame):
+    """
+    虚拟化文件列表
+
+    只把当前可见的行插入Listbox，滚动时按偏移量重新渲染，
+    因此刷新开销与可见行数有关，与文件总数无关。选中状态按文件路径记录。
+    """
+
+    def __init__(self, parent, store, height=6):
+        super().__init__(parent)
+        self.store = store
+        self.offset = 0
+        self.selected = set()
+        
+        self.listbox = tk.Listbox(self, height=height, selectmode=tk.EXTENDED, activestyle="none")
+        self.listbox.grid(row=0, column=0, sticky="nsew")
+        
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scroll)
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+        
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox.bind("<Configure>", lambda event: self.refresh())
+        self.listbox.bind("<MouseWheel>", self.on_mousewheel)
+        self.listbox.bind("<Button-4>", lambda event: self.scroll_by(-3))
+        self.listbox.bind("<Button-5>", lambda event: self.scroll_by(3))
+
+    def visible_rows(self):
+        """根据控件高度计算可见行数"""
+        height = self.listbox.winfo_height()
+        if height <= 1:
+            return int(self.listbox.cget("height"))
+        line_height = tk.font.nametofont("TkDefaultFont").metrics("linespace") + 1
+        return max(1, height // line_height)
+
+    def refresh(self):
+        """重新渲染可见行"""
+        total = len(self.store)
+        rows = self.visible_rows()
+        self.offset = max(0, min(self.offset, total - rows))
+        
+        self.listbox.delete(0, tk.END)
+        for index, path in enumerate(self.store.window(self.offset, rows)):
+            self.listbox.insert(tk.END, os.path.basename(path))
+            if path in self.selected:
+                self.listbox.selection_set(index)
+        
+        if total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + rows) / total))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def scroll_by(self, rows):
+        self.offset += rows
+        self.refresh()
+        return "break"
+
+    def on_scroll(self, action, value, unit=None):
+        """处理滚动条拖动和点击"""
+        if action == tk.MOVETO:
+            self.offset = int(float(value) * len(self.store))
+            self.refresh()
+        elif action == tk.SCROLL:
+            step = self.visible_rows() if unit == tk.PAGES else 1
+            self.scroll_by(int(value) * step)
+
+    def on_mousewheel(self, event):
+        return self.scroll_by(-3 if event.delta > 0 else 3)
+
+    def on_select(self, event):
+        """把可见行的选中状态同步到按路径记录的选中集合"""
+        for index, path in enumerate(self.store.window(self.offset, self.listbox.size())):
+            if self.listbox.selection_includes(index):
+                self.selected.add(path)
+            else:
+                self.selected.discard(path)
+
+    def selected_paths(self):
+        """返回仍在列表中的选中文件"""
+        return [path for path in self.selected if path in self.store]
+
+    def clear_selection(self):
+        self.selected.clear()
+
 
 class KGMConverterGUI:
     def __init__(self, root):
@@ -25,12 +137,26 @@ class KGMConverterGUI:
         self.root.rowconfigure(0, weight=1)
         
         # 初始化变量
-        self.selected_files = []
+        self.selected_files = kgm_core.FileStore()
         self.conversion_queue = Queue()
         self.is_converting = False
         self.is_paused = False
         self.conversion_thread = None
         self.last_directory = os.path.expanduser("~")
+        self.worker_count = tk.IntVar(value=os.cpu_count() or 1)
+        self.skip_converted = tk.BooleanVar(value=True)
+        self.pipeline_mode = tk.BooleanVar(value=False)
+        self.durability = tk.StringVar(value="none")
+        self.dedup_inputs = tk.BooleanVar(value=False)
+        self.keep_partial = tk.BooleanVar(value=False)
+        # 与工作进程共享的暂停/取消开关，每批转换新建一个
+        self.control = None
+        self.schedule_policy = tk.StringVar(value=SCHEDULE_LABELS[0][1])
+        self.output_mode = tk.StringVar(value=OUTPUT_LABELS[0][1])
+        self.manifest = None
+        
+        # 后台线程到界面线程的事件队列，deque的append/popleft是原子操作，无需加锁
+        self.ui_events = deque()
         
         # 创建暂停事件
         self.pause_event = threading.Event()
@@ -47,20 +173,18 @@ class KGMConverterGUI:
         
         # 绑定关闭窗口事件
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        
+        # 启动界面事件处理循环
+        self.root.after(UI_FRAME_INTERVAL, self.process_ui_events)
 
     def create_file_selection_area(self):
         # 文件选择区域框架
         file_frame = ttk.LabelFrame(self.main_frame, text="文件选择", padding="5")
         file_frame.grid(row=0, column=0, columnspan=2, sticky="nsew", pady=5)
         
-        # 文件列表
-        self.file_listbox = tk.Listbox(file_frame, height=6)
-        self.file_listbox.grid(row=0, column=0, columnspan=2, sticky="nsew")
-        
-        # 滚动条
-        scrollbar = ttk.Scrollbar(file_frame, orient=tk.VERTICAL, command=self.file_listbox.yview)
-        scrollbar.grid(row=0, column=2, sticky="ns")
-        self.file_listbox.configure(yscrollcommand=scrollbar.set)
+        # 文件列表（虚拟化，只渲染可见行）
+        self.file_list = VirtualFileList(file_frame, self.selected_files, height=6)
+        self.file_list.grid(row=0, column=0, columnspan=3, sticky="nsew")
         
         # 按钮框架
         btn_frame = ttk.Frame(file_frame)
@@ -78,6 +202,18 @@ class KGMConverterGUI:
         remove_btn = ttk.Button(btn_frame, text="删除选中", command=self.remove_selected)
         remove_btn.grid(row=0, column=2, padx=5)
         
+        # 跳过已转换文件选项
+        skip_check = ttk.Checkbutton(btn_frame, text="跳过已转换文件", variable=self.skip_converted)
+        skip_check.grid(row=0, column=3, padx=5)
+        
+        # 内容去重选项
+        dedup_check = ttk.Checkbutton(btn_frame, text="相同内容只转换一次", variable=self.dedup_inputs)
+        dedup_check.grid(row=0, column=4, padx=5)
+        
+        # 取消时保留未完成的输出，下次转换从中断处继续
+        keep_check = ttk.Checkbutton(btn_frame, text="取消时保留未完成部分", variable=self.keep_partial)
+        keep_check.grid(row=0, column=5, padx=5)
+        
         file_frame.columnconfigure(0, weight=1)
 
     def create_progress_area(self):
@@ -126,6 +262,60 @@ class KGMConverterGUI:
         )
         self.cancel_btn.grid(row=0, column=2, padx=5, pady=10)
         
+        # 并行进程数设置
+        worker_frame = ttk.Frame(progress_frame)
+        worker_frame.grid(row=3, column=0, columnspan=3, sticky="w")
+        ttk.Label(worker_frame, text="并行进程数:").grid(row=0, column=0)
+        self.worker_spinbox = ttk.Spinbox(
+            worker_frame,
+            from_=1,
+            to=64,
+            width=5,
+            textvariable=self.worker_count
+        )
+        self.worker_spinbox.grid(row=0, column=1)
+        
+        # 流水线模式：单进程读取/解密/写入重叠执行，适合机械硬盘
+        pipeline_check = ttk.Checkbutton(
+            worker_frame,
+            text="流水线模式（机械硬盘）",
+            variable=self.pipeline_mode
+        )
+        pipeline_check.grid(row=0, column=2, padx=10)
+        
+        # 输出同步策略
+        ttk.Label(worker_frame, text="写入同步:").grid(row=0, column=3)
+        durability_combo = ttk.Combobox(
+            worker_frame,
+            textvariable=self.durability,
+            values=kgm_core.DURABILITY_POLICIES,
+            width=6,
+            state="readonly"
+        )
+        durability_combo.grid(row=0, column=4)
+        
+        # 任务调度顺序
+        ttk.Label(worker_frame, text="调度:").grid(row=0, column=5, padx=(10, 0))
+        schedule_combo = ttk.Combobox(
+            worker_frame,
+            textvariable=self.schedule_policy,
+            values=[label for _, label in SCHEDULE_LABELS],
+            width=10,
+            state="readonly"
+        )
+        schedule_combo.grid(row=0, column=6)
+        
+        # 输出方式：单独文件，或直接写入不压缩的归档（适合网络共享）
+        ttk.Label(worker_frame, text="输出:").grid(row=0, column=7, padx=(10, 0))
+        output_combo = ttk.Combobox(
+            worker_frame,
+            textvariable=self.output_mode,
+            values=[label for _, label in OUTPUT_LABELS],
+            width=8,
+            state="readonly"
+        )
+        output_combo.grid(row=0, column=8)
+        
         progress_frame.columnconfigure(0, weight=1)
 
     def create_status_area(self):
@@ -148,13 +338,13 @@ class KGMConverterGUI:
         """添加文件"""
         files = filedialog.askopenfilenames(
             title="选择KGM文件",
-            filetypes=[("KGM文件", "*.kgm"), ("所有文件", "*.*")],
+            filetypes=[("KGM文件", "*.kgm *.vpr *.kwm"), ("所有文件", "*.*")],
             initialdir=self.last_directory
         )
         
         if files:
             self.last_directory = os.path.dirname(files[0])
-            self.selected_files.extend(files)
+            self.selected_files.add_many(os.path.realpath(f) for f in files)
             self.update_file_list()
 
     def add_folder(self):
@@ -166,37 +356,116 @@ class KGMConverterGUI:
         
         if folder:
             self.last_directory = folder
-            for root, _, files in os.walk(folder):
-                for file in files:
-                    if file.lower().endswith('.kgm'):
-                        self.selected_files.append(os.path.join(root, file))
+            self.update_status(f"正在扫描: {folder}")
+            threading.Thread(target=self.scan_folder_worker, args=(folder,), daemon=True).start()
+
+    def scan_folder_worker(self, folder):
+        """后台扫描文件夹，分批把结果交给界面线程加入列表"""
+        found = 0
+        try:
+            for batch in kgm_core.scan_kgm_files(folder):
+                found += len(batch)
+                self.post_event("call", self.add_scanned_batch, batch)
+        except Exception as e:
+            self.update_status(f"扫描失败: {folder} - {str(e)}")
+            return
+        self.update_status(f"扫描完成: {folder}，找到 {found} 个KGM文件")
+
+    def add_scanned_batch(self, batch):
+        """把一批扫描结果加入文件列表（重复文件自动忽略）"""
+        if self.selected_files.add_entries(batch):
             self.update_file_list()
 
     def remove_selected(self):
         """删除选中的文件"""
-        selection = self.file_listbox.curselection()
+        selection = self.file_list.selected_paths()
         if not selection:
             return
             
-        # 从后往前删除，避免索引变化
-        for index in reversed(selection):
-            del self.selected_files[index]
-            
+        self.selected_files.remove_many(selection)
+        self.file_list.clear_selection()
         self.update_file_list()
 
     def update_file_list(self):
-        """更新文件列表显示"""
-        self.file_listbox.delete(0, tk.END)
-        for file in self.selected_files:
-            self.file_listbox.insert(tk.END, os.path.basename(file))
+        """更新文件列表显示（只重绘可见行）"""
+        self.file_list.refresh()
 
     def update_progress(self, value):
         """更新进度条"""
         self.total_progress["value"] = value
 
+    def post_event(self, kind, *args):
+        """
+        从任意线程投递界面事件
+
+        kind 为 "log"（状态信息）、"progress"（采样结果）或 "call"（在界面线程调用函数）
+        """
+        self.ui_events.append((kind, args))
+
+    def process_ui_events(self):
+        """按固定帧率处理事件：合并日志、只保留最新进度"""
+        lines = []
+        latest_sample = None
+        calls = []
+        
+        # 只处理本帧开始时已有的事件，避免后台线程持续投递时界面无法返回
+        for _ in range(len(self.ui_events)):
+            kind, args = self.ui_events.popleft()
+            if kind == "log":
+                lines.append(args[0])
+            elif kind == "progress":
+                latest_sample = args[0]
+            elif kind == "call":
+                calls.append(args)
+        
+        try:
+            if lines:
+                self.append_status_lines(lines)
+            if latest_sample is not None:
+                self.show_progress(latest_sample)
+            for func, *func_args in calls:
+                func(*func_args)
+        finally:
+            self.root.after(UI_FRAME_INTERVAL, self.process_ui_events)
+
+    def report_progress(self, sample):
+        """转换调度线程的采样回调，转交给界面线程显示"""
+        self.post_event("progress", sample)
+
+    def show_progress(self, sample):
+        """按字节显示总体进度、在途文件进度、速度和剩余时间"""
+        self.update_progress(sample['bytes_done'])
+        
+        files = " | ".join(
+            f"{os.path.basename(f)} {done * 100 // total if total else 100}%"
+            for f, done, total in sample['files'][:3]
+        )
+        if len(sample['files']) > 3:
+            files += f" 等{len(sample['files'])}个文件"
+        eta = self.format_time(sample['eta']) if sample['eta'] is not None else "--"
+        self.current_file_label.configure(
+            text=f"正在转换: {files}\n"
+                 f"当前速度: {self.format_size(sample['rate'])}/s  "
+                 f"平均速度: {self.format_size(sample['avg_rate'])}/s  "
+                 f"剩余时间: {eta}"
+        )
+
     def update_status(self, message):
-        """更新状态信息"""
-        self.status_text.insert(tk.END, message + "\n")
+        """更新状态信息（线程安全，在下一帧统一写入）"""
+        self.post_event("log", message)
+
+    def append_status_lines(self, lines):
+        """一次性写入多行状态信息，并只保留最近的 MAX_STATUS_LINES 行"""
+        text = "\n".join(lines) + "\n"
+        # 一帧内的日志过多时只写入末尾部分
+        text_lines = text.splitlines(keepends=True)
+        if len(text_lines) > MAX_STATUS_LINES:
+            text = "".join(text_lines[-MAX_STATUS_LINES:])
+        self.status_text.insert(tk.END, text)
+        
+        line_count = int(self.status_text.index("end-1c").split(".")[0])
+        if line_count > MAX_STATUS_LINES:
+            self.status_text.delete("1.0", f"{line_count - MAX_STATUS_LINES + 1}.0")
         self.status_text.see(tk.END)
 
     def format_size(self, size):
@@ -219,19 +488,9 @@ class KGMConverterGUI:
             return f"{seconds}秒"
 
     def convert_kgm_to_mp3(self, input_file, output_file):
-        """转换KGM文件为MP3"""
+        """转换KGM文件为MP3（分块流式解密，内存占用与文件大小无关）"""
         try:
-            # 读取KGM文件
-            with open(input_file, 'rb') as f:
-                data = f.read()
-            
-            # 解密数据（示例使用异或解密，实际应根据KGM格式规范实现）
-            decrypted_data = bytes(b ^ 0x4C for b in data)  # 使用0x4C作为异或密钥
-            
-            # 写入MP3文件
-            with open(output_file, 'wb') as f:
-                f.write(decrypted_data)
-                
+            return kgm_core.convert_kgm_to_mp3(input_file, output_file)
         except Exception as e:
             raise Exception(f"转换失败: {str(e)}")
 
@@ -243,10 +502,14 @@ class KGMConverterGUI:
         self.is_paused = not self.is_paused
         if self.is_paused:
             self.pause_event.clear()  # 暂停转换
+            if self.control:
+                self.control.pause()  # 在途文件在下一个分块边界暂停
             self.pause_btn.configure(text="继续")
             self.update_status("转换已暂停")
         else:
             self.pause_event.set()  # 继续转换
+            if self.control:
+                self.control.resume()
             self.pause_btn.configure(text="暂停")
             self.update_status("转换已继续")
             
@@ -257,6 +520,8 @@ class KGMConverterGUI:
             
         if messagebox.askyesno("确认取消", "确定要取消当前的转换任务吗？"):
             self.is_converting = False
+            if self.control:
+                self.control.cancel()  # 在途文件在下一个分块边界停止
             # 清空转换队列
             while not self.conversion_queue.empty():
                 self.conversion_queue.get()
@@ -267,6 +532,8 @@ class KGMConverterGUI:
         if self.is_converting:
             if messagebox.askyesno("确认退出", "正在进行转换，确定要退出吗？"):
                 self.is_converting = False
+                if self.control:
+                    self.control.cancel()
                 self.root.destroy()
         else:
             self.root.destroy()
@@ -289,8 +556,34 @@ class KGMConverterGUI:
         # 更新最后访问的目录
         self.last_directory = output_dir
             
-        # 将文件添加到转换队列
-        for file_path in self.selected_files:
+        # 根据转换清单过滤掉已转换且未变化的文件
+        files = list(self.selected_files)
+        self.manifest = None
+        if self.skip_converted.get():
+            try:
+                self.manifest = kgm_core.ConversionManifest(output_dir)
+                files = self.manifest.filter_jobs(files)
+            except Exception as e:
+                self.manifest = None
+                self.update_status(f"无法读取转换清单，将转换全部文件: {str(e)}")
+            skipped = len(self.selected_files) - len(files)
+            if skipped:
+                self.update_status(f"跳过 {skipped} 个已转换的文件")
+            if not files:
+                if self.manifest:
+                    self.manifest.close()
+                    self.manifest = None
+                messagebox.showinfo("提示", "所选文件均已转换，无需重复转换")
+                return
+            
+        # 按调度策略排列后加入转换队列，同时统计总字节数用于按字节显示进度
+        policy = dict((label, name) for name, label in SCHEDULE_LABELS).get(self.schedule_policy.get(), "fifo")
+        entries = kgm_core.schedule_jobs(
+            [(file_path, self.selected_files.size(file_path)) for file_path in files], policy
+        )
+        total_bytes = 0
+        for file_path, size in entries:
+            total_bytes += size
             self.conversion_queue.put((file_path, output_dir))
             
         # 更新按钮状态
@@ -300,96 +593,162 @@ class KGMConverterGUI:
             
         # 重置进度条和状态
         self.total_progress["value"] = 0
-        self.total_progress["maximum"] = len(self.selected_files)
+        self.total_progress["maximum"] = max(total_bytes, 1)
         self.is_paused = False
         self.pause_event.set()
+        self.control = kgm_core.ConversionControl(keep_partial=self.keep_partial.get())
             
         # 开始转换
         self.is_converting = True
-        self.conversion_thread = threading.Thread(target=self.conversion_worker)
+        try:
+            workers = self.worker_count.get()
+        except tk.TclError:
+            workers = os.cpu_count() or 1
+        self.conversion_thread = threading.Thread(
+            target=self.conversion_worker,
+            args=(workers, total_bytes, self.pipeline_mode.get(), self.durability.get(),
+                  entries, self.dedup_inputs.get(),
+                  dict((label, fmt) for fmt, label in OUTPUT_LABELS).get(self.output_mode.get()))
+        )
         self.conversion_thread.daemon = True
         self.conversion_thread.start()
 
-    def conversion_worker(self):
-        """转换工作线程"""
+    def iter_queued_jobs(self):
+        """从转换队列中逐个取出任务，队列被清空（取消）时自然结束"""
+        while True:
+            try:
+                job = self.conversion_queue.get_nowait()
+            except Empty:
+                return
+            self.conversion_queue.task_done()
+            yield job
+
+    def conversion_worker(self, workers, total_bytes, pipeline=False, durability="none", entries=(),
+                          dedup_inputs=False, archive=None):
+        """
+        转换调度线程，实际解密在进程池中并行执行
+        
+        entries 为按调度顺序排列的 (路径, 大小)，与转换队列顺序一致，用于估算剩余时间。
+        dedup_inputs 为True时先按内容查找重复文件，重复项不再解密，直接链接已转换的输出。
+        archive 为 "tar" 或 "zip" 时输出直接写入归档，此时不做去重
+        """
         converted_count = 0
         failed_files = []
         total_size = 0
+        worker_stats = {}  # 每个工作进程的 [字节数, 耗时]
+        metrics = kgm_core.StageMetrics()
         start_time = time.time()
-        pause_start_time = 0
-        total_pause_time = 0
-        
-        while not self.conversion_queue.empty() and self.is_converting:
-            # 检查暂停状态
-            if self.is_paused:
-                if pause_start_time == 0:
-                    pause_start_time = time.time()
-                    self.update_status("转换已暂停")
-                self.pause_event.wait()  # 等待继续信号
-                if pause_start_time > 0:
-                    total_pause_time += time.time() - pause_start_time
-                    pause_start_time = 0
-                    
-            input_file, output_dir = self.conversion_queue.get()
-            try:
-                # 获取文件大小
-                file_size = os.path.getsize(input_file)
-                total_size += file_size
-                size_str = self.format_size(file_size)
-                
-                # 更新当前处理文件显示
-                self.root.after(0, self.current_file_label.configure, 
-                              {"text": f"正在转换: {os.path.basename(input_file)} ({size_str})"})
+        
+        try:
+            dedup = None
+            jobs = self.iter_queued_jobs()
+            if dedup_inputs and archive:
+                self.update_status("归档输出不支持去重，将转换全部文件")
+            elif dedup_inputs:
+                self.post_event("call", self.current_file_label.configure, {"text": "正在查找重复文件..."})
+                dedup = kgm_core.DedupPlan.build(entries)
+                if dedup.duplicates:
+                    self.update_status(
+                        f"发现 {len(dedup.duplicates)} 个重复文件，"
+                        f"可省去 {self.format_size(dedup.duplicate_bytes)} 的转换"
+                    )
+                # 只派发计划时确定的原文件；dedup.duplicates 会在转换过程中被 resolve 修改，
+                # 首尾摘要相同但内容不同的候选由进程池自己补转，这里不能再放行
+                unique = frozenset(dedup.unique)
+                jobs = (job for job in jobs if job[0] in unique)
+                entries = [entry for entry in entries if entry[0] in unique]
+        
+            pool = kgm_core.ConversionPool(workers=workers, pipeline=pipeline, durability=durability,
+                                           archive=archive)
+            mode = "流水线模式" if pipeline else f"{pool.workers} 个进程"
+            self.post_event("call", self.current_file_label.configure,
+                            {"text": f"正在转换 ({mode})..."})
+        
+            for result in pool.run(jobs, self.pause_event,
+                                   lambda: not self.is_converting,
+                                   on_sample=self.report_progress,
+                                   total_bytes=total_bytes,
+                                   dedup=dedup,
+                                   schedule=[size for _, size in entries],
+                                   control=self.control):
+                input_file = result['input']
+                metrics.observe(result)
+                if result['cancelled']:
+                    note = "，已保留部分输出，下次从中断处继续" if self.control.keep_partial else ""
+                    self.update_status(f"已取消: {os.path.basename(input_file)}{note}")
+                    continue
+                if result['error']:
+                    failed_files.append((input_file, result['error']))
+                    self.update_status(f"转换失败: {os.path.basename(input_file)} - {result['error']}")
+                    continue
                 
-                # 构建输出文件路径
-                output_file = os.path.join(output_dir, 
-                                         os.path.splitext(os.path.basename(input_file))[0] + '.mp3')
+                # 已完整写出的文件都记入清单，下次运行可以跳过
+                if self.manifest:
+                    self.manifest.record(input_file, result['output'], result['hash'])
                 
-                # 执行转换
-                if self.is_converting:  # 再次检查是否取消
-                    self.convert_kgm_to_mp3(input_file, output_file)
-                    
-                    if self.is_converting:  # 转换完成后再次检查是否取消
-                        converted_count += 1
-                        
-                        # 计算转换速度（不包括暂停时间）
-                        elapsed_time = time.time() - start_time - total_pause_time
-                        if elapsed_time > 0:
-                            speed = total_size / elapsed_time
-                            speed_str = f"平均速度: {self.format_size(speed)}/s"
-                        else:
-                            speed_str = ""
-                        
-                        # 更新进度和状态
-                        self.root.after(0, self.update_progress, converted_count)
-                        self.update_status(
-                            f"成功转换: {os.path.basename(input_file)} ({size_str}) {speed_str}"
-                        )
+                if not self.is_converting:  # 转换完成后再次检查是否取消
+                    continue
                 
-            except Exception as e:
-                failed_files.append((input_file, str(e)))
-                self.update_status(f"转换失败: {os.path.basename(input_file)} - {str(e)}")
+                converted_count += 1
+                if result['dedup_of']:
+                    self.update_status(
+                        f"复用输出: {os.path.basename(input_file)} (与 {os.path.basename(result['dedup_of'])} 内容相同)"
+                    )
+                    continue
+                total_size += result['size']
+                stats = worker_stats.setdefault(result['worker'], [0, 0.0])
+                stats[0] += result['size']
+                stats[1] += result['seconds']
             
-            self.conversion_queue.task_done()
+                # 计算转换速度（不包括暂停时间）
+                elapsed_time = time.time() - start_time - pool.pause_time
+                if elapsed_time > 0:
+                    speed = total_size / elapsed_time
+                    speed_str = f"平均速度: {self.format_size(speed)}/s"
+                else:
+                    speed_str = ""
             
-            # 定期进行垃圾回收
-            if converted_count % 5 == 0:
-                gc.collect()
-        
-        # 计算总体统计信息
-        if converted_count > 0:
-            total_time = time.time() - start_time - total_pause_time
-            if total_time > 0:
-                avg_speed = total_size / total_time
+                # 更新状态（进度条由采样回调按字节更新）
                 self.update_status(
-                    f"\n转换完成统计:\n"
-                    f"总大小: {self.format_size(total_size)}\n"
-                    f"总耗时: {self.format_time(total_time)}\n"
-                    f"平均速度: {self.format_size(avg_speed)}/s"
+                    f"成功转换: {os.path.basename(input_file)} ({self.format_size(result['size'])}) {speed_str}"
                 )
         
-        # 转换完成，恢复UI状态
-        self.root.after(0, self.conversion_completed, converted_count, failed_files)
+            if archive and converted_count:
+                self.update_status(f"输出已写入归档: {pool.archive_prefix}-*.{archive}")
+        
+            # 计算总体统计信息
+            if converted_count > 0:
+                total_time = time.time() - start_time - pool.pause_time
+                if total_time > 0:
+                    avg_speed = total_size / total_time
+                    stage_summary = metrics.summary()
+                    stage_total = sum(stage_summary['stages'].values()) or 1
+                    stage_line = "、".join(
+                        f"{stage} {seconds / stage_total:.0%}" for stage, seconds in stage_summary['stages'].items()
+                    )
+                    bound = {"disk": "磁盘I/O", "cpu": "解密计算"}.get(stage_summary['bound'], "未知")
+                    worker_lines = "".join(
+                        f"进程 {pid}: {self.format_size(size / seconds if seconds > 0 else 0)}/s\n"
+                        for pid, (size, seconds) in sorted(worker_stats.items())
+                    )
+                    self.update_status(
+                        f"\n转换完成统计:\n"
+                        f"总大小: {self.format_size(total_size)}\n"
+                        f"总耗时: {self.format_time(total_time)}\n"
+                        f"平均速度: {self.format_size(avg_speed)}/s\n"
+                        f"去重节省: {self.format_size(pool.saved_bytes)}\n"
+                        f"阶段耗时: {stage_line}（瓶颈: {bound}）\n"
+                        f"{worker_lines}"
+                    )
+        except Exception as e:
+            # 去重扫描或进程池出错时也要走到下面的收尾，不能让按钮一直不可用
+            self.update_status(f"转换中断: {str(e)}")
+        finally:
+            if self.manifest:
+                self.manifest.close()
+                self.manifest = None
+            # 转换完成，恢复UI状态
+            self.post_event("call", self.conversion_completed, converted_count, failed_files)
 
     def conversion_completed(self, converted_count, failed_files):
         """转换完成后的处理"""
@@ -420,9 +779,15 @@ class KGMConverterGUI:
             
         # 清空选择的文件列表
         self.selected_files.clear()
+        self.file_list.clear_selection()
         self.update_file_list()
 
 def main():
+    multiprocessing.freeze_support()
+    # 带 --watch 参数时以无界面的监视服务运行
+    if "--watch" in sys.argv[1:]:
+        import kgm_watch
+        sys.exit(kgm_watch.main(sys.argv[1:]))
     root = tk.Tk()
     app = KGMConverterGUI(root)
     root.mainloop()
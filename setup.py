@@ -19,8 +19,8 @@ if __name__ == '__main__':
         '--hidden-import=tkinter.ttk',
         '--hidden-import=tkinter.filedialog',
         '--hidden-import=tkinter.messagebox',
+        '--hidden-import=numpy',  # STL引擎
         # 排除不需要的模块
-        '--exclude-module=numpy',
         '--exclude-module=scipy',
         '--exclude-module=pandas',
         '--exclude-module=matplotlib',
@@ -0,0 +1,238 @@
+"""
+基于numpy的STL读写引擎
+
+二进制STL用结构化dtype一次读入；ASCII STL按行分批流式解析，每批转成数组，
+内存占用只比结果数组多一批的文本。支持二进制/ASCII互转、按比例缩放和合并，
+不依赖FreeCAD。
+"""
+import os
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # numpy为可选依赖，缺失时STL转换退回FreeCAD
+    np = None
+
+# 二进制STL的文件头长度和每个三角形的记录格式（50字节）
+HEADER_SIZE = 80
+if np is not None:
+    TRIANGLE_DTYPE = np.dtype([
+        ('normal', '<f4', (3,)),
+        ('vertices', '<f4', (3, 3)),
+        ('attribute', '<u2'),
+    ])
+
+# ASCII解析和写出时每批处理的三角形数
+DEFAULT_BATCH = 65536
+
+
+def available():
+    """numpy是否可用"""
+    return np is not None
+
+
+class StlMesh:
+    """
+    三角网格
+
+    参数:
+        triangles (numpy.ndarray): TRIANGLE_DTYPE结构化数组
+        name (str): 网格名称（ASCII的solid名或二进制文件头）
+    """
+
+    def __init__(self, triangles, name=""):
+        self.triangles = triangles
+        self.name = name
+
+    def __len__(self):
+        return len(self.triangles)
+
+    @property
+    def vertices(self):
+        """(n, 3, 3) 顶点坐标视图"""
+        return self.triangles['vertices']
+
+    @property
+    def normals(self):
+        """(n, 3) 法向量视图"""
+        return self.triangles['normal']
+
+    def scale(self, factor):
+        """按比例缩放顶点坐标（原地修改）；负比例相当于镜像，交换顶点顺序保持法向朝外"""
+        self.vertices[...] *= np.float32(factor)
+        if factor < 0:
+            self.vertices[:, [1, 2]] = self.vertices[:, [2, 1]]
+            self.update_normals()
+        return self
+
+    def update_normals(self):
+        """根据顶点重新计算单位法向量"""
+        vertices = self.vertices
+        normals = np.cross(vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        np.divide(normals, lengths, out=normals, where=lengths > 0)
+        self.normals[...] = normals
+        return self
+
+
+def is_binary(path):
+    """
+    判断STL文件是否为二进制格式
+
+    以文件大小与头部声明的三角形数是否吻合为准，
+    因为不少二进制STL的文件头也以"solid"开头。
+    """
+    size = os.path.getsize(path)
+    if size < HEADER_SIZE + 4:
+        return False
+    with open(path, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        count = struct.unpack('<I', f.read(4))[0]
+    return size == HEADER_SIZE + 4 + count * TRIANGLE_DTYPE.itemsize
+
+
+def _solid_name(text):
+    """
+    去掉名称开头多余的"solid"关键字
+
+    很多程序写二进制文件头时以"solid 名称"开头，ASCII文件里也会出现"solid solid 名称"，
+    直接当作名称会在写出时变成"solid solid ..."。只去掉独立的单词，"solidworks"之类保持不变。
+    """
+    text = text.strip()
+    while text[:5].lower() == 'solid' and (len(text) == 5 or text[5].isspace()):
+        text = text[5:].strip()
+    return text
+
+
+def read_binary(path):
+    """读取二进制STL"""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        count = struct.unpack('<I', f.read(4))[0]
+        triangles = np.fromfile(f, dtype=TRIANGLE_DTYPE, count=count)
+    if len(triangles) != count:
+        raise ValueError(f"STL文件不完整: 声明 {count} 个三角形，实际 {len(triangles)} 个")
+    name = _solid_name(header.split(b'\0', 1)[0].decode('ascii', errors='ignore'))
+    return StlMesh(triangles, name)
+
+
+def read_ascii(path, batch=DEFAULT_BATCH):
+    """
+    流式读取ASCII STL
+
+    逐行扫描，只收集"facet normal"和"vertex"行的数值文本，
+    每攒够batch个三角形就整体转换成数组。
+    """
+    name = ""
+    chunks = []
+    normals = []
+    vertices = []
+
+    def flush():
+        if not normals:
+            return
+        chunk = np.zeros(len(normals), dtype=TRIANGLE_DTYPE)
+        chunk['normal'] = np.array(' '.join(normals).split(), dtype=np.float32).reshape(-1, 3)
+        values = np.array(' '.join(vertices).split(), dtype=np.float32)
+        if len(values) != len(normals) * 9:
+            raise ValueError(f"ASCII STL格式错误: {path}")
+        chunk['vertices'] = values.reshape(-1, 3, 3)
+        chunks.append(chunk)
+        normals.clear()
+        vertices.clear()
+
+    with open(path, 'r', encoding='ascii', errors='ignore') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('vertex'):
+                vertices.append(line[6:])
+            elif line.startswith('facet'):
+                normals.append(line.split('normal', 1)[1] if 'normal' in line else '0 0 0')
+                if len(normals) >= batch:
+                    # 当前三角形的顶点还没读到，先把之前的完整三角形转换掉
+                    pending = normals.pop()
+                    flush()
+                    normals.append(pending)
+            elif line.startswith('solid') and not name:
+                name = _solid_name(line)
+        flush()
+
+    if chunks:
+        triangles = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+    else:
+        triangles = np.zeros(0, dtype=TRIANGLE_DTYPE)
+    return StlMesh(triangles, name)
+
+
+def read(path, batch=DEFAULT_BATCH):
+    """自动识别格式并读取STL文件"""
+    if is_binary(path):
+        return read_binary(path)
+    return read_ascii(path, batch)
+
+
+def write_binary(mesh, path):
+    """写出二进制STL"""
+    header = mesh.name.encode('ascii', errors='ignore')[:HEADER_SIZE].ljust(HEADER_SIZE, b' ')
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(struct.pack('<I', len(mesh)))
+        mesh.triangles.astype(TRIANGLE_DTYPE, copy=False).tofile(f)
+
+
+def write_ascii(mesh, path, batch=DEFAULT_BATCH):
+    """分批写出ASCII STL，数值用 %.9g 输出，float32 读回后与原值完全相同"""
+    facet = (
+        "facet normal %.9g %.9g %.9g\n"
+        "  outer loop\n"
+        "    vertex %.9g %.9g %.9g\n"
+        "    vertex %.9g %.9g %.9g\n"
+        "    vertex %.9g %.9g %.9g\n"
+        "  endloop\n"
+        "endfacet\n"
+    )
+    name = _solid_name(mesh.name) or "mesh"
+    with open(path, 'w', encoding='ascii', newline='\n') as f:
+        f.write(f"solid {name}\n")
+        for start in range(0, len(mesh), batch):
+            chunk = mesh.triangles[start:start + batch]
+            rows = np.concatenate([chunk['normal'], chunk['vertices'].reshape(-1, 9)], axis=1)
+            f.write(''.join(facet % tuple(row) for row in rows.tolist()))
+        f.write(f"endsolid {name}\n")
+
+
+def write(mesh, path, binary=True, batch=DEFAULT_BATCH):
+    """写出STL文件"""
+    if binary:
+        write_binary(mesh, path)
+    else:
+        write_ascii(mesh, path, batch)
+
+
+def merge(meshes, name=""):
+    """把多个网格合并为一个"""
+    meshes = list(meshes)
+    if not meshes:
+        return StlMesh(np.zeros(0, dtype=TRIANGLE_DTYPE), name)
+    triangles = np.concatenate([mesh.triangles for mesh in meshes])
+    return StlMesh(triangles, name or meshes[0].name)
+
+
+def convert(input_files, output_file, binary=True, scale=1.0):
+    """
+    读取一个或多个STL文件，合并、缩放后写出
+
+    参数:
+        input_files (list): 输入STL文件路径
+        output_file (str): 输出文件路径
+        binary (bool): 输出二进制(True)或ASCII(False)
+        scale (float): 坐标缩放比例
+
+    返回:
+        int: 输出的三角形数
+    """
+    mesh = merge(read(path) for path in input_files)
+    if scale != 1.0:
+        mesh.scale(scale)
+    write(mesh, output_file, binary)
+    return len(mesh)